@@ -0,0 +1,223 @@
+import datetime
+import random
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+from urlparse import urlparse
+
+
+TIME_FMT = "%Y-%m-%dT%H:%M:%S.000Z"
+# EC2 responses are not wrapped in a Result element like autoscale ones
+EC2_ACTIONS = ["DescribeInstances", "StartInstances", "StopInstances"]
+
+
+class FakeGroup(object):
+    def __init__(self, name, lc_name, zone):
+        self.name = name
+        self.lc_name = lc_name
+        self.zone = zone
+        self.desired_capacity = 0
+        self.instance_ids = []
+
+
+class FakeCloudState(object):
+    """Instances and autoscale groups behind the fake EC2/autoscale API.
+
+    Setting the desired capacity of a group launches or removes instances
+    immediately. Instance DNS names are generated by dns_name_for, so they
+    can be made to match the nodes of a fake Torque cluster.
+    """
+    def __init__(self, dns_name_for, charge_time_secs=3600, seed=0):
+        self.dns_name_for = dns_name_for
+        self.charge_time_secs = charge_time_secs
+        self.launch_configs = {}
+        self.groups = {}
+        self.instances = {}
+        self.calls = {}
+        self._next_index = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _launch(self, group):
+        instance_id = "i-%08x" % self._next_index
+        # spread launch times over a charge period
+        age = self._random.randint(0, self.charge_time_secs)
+        launch_time = (datetime.datetime.utcnow() -
+                       datetime.timedelta(seconds=age))
+        self.instances[instance_id] = {
+            "dns_name": self.dns_name_for(self._next_index),
+            "launch_time": launch_time.strftime(TIME_FMT),
+            "state": "running",
+            "type": "m1.large"}
+        self._next_index += 1
+        group.instance_ids.append(instance_id)
+
+    def seed_group(self, name, lc_name, zone, num_instances):
+        self.launch_configs[lc_name] = lc_name
+        group = FakeGroup(name, lc_name, zone)
+        self.groups[name] = group
+        self._set_capacity(group, num_instances)
+
+    def _set_capacity(self, group, capacity):
+        group.desired_capacity = capacity
+        while len(group.instance_ids) < capacity:
+            self._launch(group)
+        while len(group.instance_ids) > capacity:
+            del self.instances[group.instance_ids.pop()]
+
+    def _terminate(self, instance_id):
+        for group in self.groups.values():
+            if instance_id in group.instance_ids:
+                group.instance_ids.remove(instance_id)
+                group.desired_capacity = len(group.instance_ids)
+        self.instances.pop(instance_id, None)
+
+    def _members(self, params, prefix):
+        members = []
+        i = 1
+        while "%s.member.%d" % (prefix, i) in params:
+            members.append(params["%s.member.%d" % (prefix, i)])
+            i += 1
+        return members
+
+    def handle(self, action, params):
+        with self._lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            handler = getattr(self, "_%s" % action, None)
+            if handler is None:
+                body = ""
+            else:
+                body = handler(params)
+        if action in EC2_ACTIONS:
+            return ("<%(a)sResponse><requestId>bench</requestId>%(body)s"
+                    "</%(a)sResponse>" % {"a": action, "body": body})
+        return ("<%(a)sResponse><%(a)sResult>%(body)s</%(a)sResult>"
+                "<ResponseMetadata><RequestId>bench</RequestId>"
+                "</ResponseMetadata></%(a)sResponse>" % {"a": action,
+                                                         "body": body})
+
+    def _DescribeInstances(self, params):
+        items = []
+        for instance_id in sorted(self.instances):
+            instance = self.instances[instance_id]
+            items.append(
+                "<item><instanceId>%s</instanceId><instanceState><name>%s"
+                "</name></instanceState><dnsName>%s</dnsName><instanceType>"
+                "%s</instanceType><launchTime>%s</launchTime></item>" % (
+                    instance_id, instance["state"], instance["dns_name"],
+                    instance["type"], instance["launch_time"]))
+        return ("<reservationSet><item><reservationId>r-bench"
+                "</reservationId><instancesSet>%s</instancesSet></item>"
+                "</reservationSet>" % "".join(items))
+
+    def _set_state(self, params, state):
+        i = 1
+        while "InstanceId.%d" % i in params:
+            instance = self.instances.get(params["InstanceId.%d" % i])
+            if instance is not None:
+                instance["state"] = state
+                if state == "running":
+                    instance["launch_time"] = (
+                        datetime.datetime.utcnow().strftime(TIME_FMT))
+            i += 1
+        return "<instancesSet/>"
+
+    def _StopInstances(self, params):
+        return self._set_state(params, "stopped")
+
+    def _StartInstances(self, params):
+        return self._set_state(params, "running")
+
+    def _DescribeLaunchConfigurations(self, params):
+        names = self._members(params, "LaunchConfigurationNames")
+        members = ["<member><LaunchConfigurationName>%s"
+                   "</LaunchConfigurationName></member>" % name
+                   for name in names if name in self.launch_configs]
+        return ("<LaunchConfigurations>%s</LaunchConfigurations>" %
+                "".join(members))
+
+    def _CreateLaunchConfiguration(self, params):
+        name = params.get("LaunchConfigurationName")
+        self.launch_configs[name] = name
+        return ""
+
+    def _DescribeAutoScalingGroups(self, params):
+        names = self._members(params, "AutoScalingGroupNames")
+        members = []
+        for name in names:
+            group = self.groups.get(name)
+            if group is None:
+                continue
+            instances = ["<member><InstanceId>%s</InstanceId>"
+                         "<LifecycleState>InService</LifecycleState>"
+                         "</member>" % i for i in group.instance_ids]
+            members.append(
+                "<member><AutoScalingGroupName>%s</AutoScalingGroupName>"
+                "<LaunchConfigurationName>%s</LaunchConfigurationName>"
+                "<DesiredCapacity>%d</DesiredCapacity><MinSize>0</MinSize>"
+                "<MaxSize>0</MaxSize><AvailabilityZones><member>%s</member>"
+                "</AvailabilityZones><Instances>%s</Instances></member>" % (
+                    group.name, group.lc_name, group.desired_capacity,
+                    group.zone, "".join(instances)))
+        return "<AutoScalingGroups>%s</AutoScalingGroups>" % "".join(members)
+
+    def _CreateAutoScalingGroup(self, params):
+        name = params.get("AutoScalingGroupName")
+        self.groups[name] = FakeGroup(name,
+                                      params.get("LaunchConfigurationName"),
+                                      params.get("AvailabilityZones.member.1"))
+        return ""
+
+    def _SetDesiredCapacity(self, params):
+        group = self.groups.get(params.get("AutoScalingGroupName"))
+        if group is not None:
+            self._set_capacity(group, int(params.get("DesiredCapacity")))
+        return ""
+
+    def _TerminateInstanceInAutoScalingGroup(self, params):
+        self._terminate(params.get("InstanceId"))
+        return "<Activity><ActivityId>bench</ActivityId></Activity>"
+
+
+class FakeCloudHandler(BaseHTTPRequestHandler):
+    def _respond(self, query):
+        params = dict((k, v[0]) for k, v in parse_qs(query).items())
+        body = self.server.state.handle(params.get("Action"), params)
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if not isinstance(body, str):
+            body = body.decode("utf-8")
+        self._respond(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCloudServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP stand-in for the EC2 and autoscale query APIs that
+    Cloud uses. Serve it on a background thread with start()."""
+    daemon_threads = True
+
+    def __init__(self, state, host="127.0.0.1", port=0):
+        HTTPServer.__init__(self, (host, port), FakeCloudHandler)
+        self.state = state
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,114 @@
+import os
+import random
+import stat
+
+
+QSTAT = """#!/bin/bash
+echo "qstat $@" >> %(calls)s
+cat %(jobs)s
+"""
+
+PBSNODES = """#!/bin/bash
+echo "pbsnodes $@" >> %(calls)s
+if [ "$1" == "-a" ]; then
+    cat %(nodes)s
+fi
+"""
+
+QMGR = """#!%(python)s
+import re
+import sys
+
+with open(%(calls)r, "a") as f:
+    f.write("qmgr %%s\\n" %% " ".join(sys.argv[1:]))
+command = sys.argv[-1]
+create = re.match(r"create node (\\S+) np=(\\d+)", command)
+delete = re.match(r"delete node (\\S+)", command)
+if create:
+    with open(%(nodes)r, "a") as f:
+        f.write("\\n%%s\\n     state = free\\n     np = %%s\\n" %% (
+            create.group(1), create.group(2)))
+elif delete:
+    with open(%(nodes)r) as f:
+        blocks = f.read().split("\\n\\n")
+    name = delete.group(1)
+    blocks = [b for b in blocks if b.strip().split("\\n")[0] != name]
+    with open(%(nodes)r, "w") as f:
+        f.write("\\n\\n".join(blocks))
+"""
+
+NODE_STATES = ["free", "job-exclusive", "down"]
+
+
+def node_name(index):
+    return "node%05d.bench" % index
+
+
+def _hhmmss(secs):
+    return "%02d:%02d:%02d" % (secs // 3600, (secs % 3600) // 60, secs % 60)
+
+
+class FakeTorque(object):
+    """Generates qstat, pbsnodes and qmgr executables under a fake
+    cluster_directory. Every invocation is appended to a calls file."""
+    def __init__(self, directory, python="/usr/bin/env python"):
+        self.directory = directory
+        self.python = python
+        self.bin_directory = os.path.join(directory, "bin")
+        self.calls_file = os.path.join(directory, "calls")
+        self.jobs_file = os.path.join(directory, "qstat.out")
+        self.nodes_file = os.path.join(directory, "pbsnodes.out")
+
+    def _write_executable(self, name, contents):
+        path = os.path.join(self.bin_directory, name)
+        with open(path, "w") as f:
+            f.write(contents % {"calls": self.calls_file,
+                                "jobs": self.jobs_file,
+                                "nodes": self.nodes_file,
+                                "python": self.python})
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+                 stat.S_IXOTH)
+
+    def generate(self, num_nodes, num_jobs, cores_per_node=2, seed=0):
+        rand = random.Random(seed)
+        if not os.path.exists(self.bin_directory):
+            os.makedirs(self.bin_directory)
+        self._write_executable("qstat", QSTAT)
+        self._write_executable("pbsnodes", PBSNODES)
+        self._write_executable("qmgr", QMGR)
+        open(self.calls_file, "w").close()
+
+        states = [rand.choice(NODE_STATES) for i in range(num_nodes)]
+        with open(self.nodes_file, "w") as f:
+            for i in range(num_nodes):
+                f.write("\n%s\n     state = %s\n     np = %d\n" % (
+                    node_name(i), states[i], cores_per_node))
+        busy = [i for i in range(num_nodes) if states[i] == "job-exclusive"]
+        with open(self.jobs_file, "w") as f:
+            f.write("\nserver.bench:\n")
+            f.write("Job ID  Username Queue Jobname SessID NDS TSK "
+                    "Memory Time S Time\n")
+            for j in range(num_jobs):
+                walltime = rand.randint(60, 48 * 3600)
+                if j < len(busy):
+                    host = node_name(busy[j])
+                    exec_host = "+".join("%s/%d" % (host, c)
+                                         for c in range(cores_per_node))
+                    f.write("%d.server bench default job%d %d 1 %d -- %s "
+                            "R %s %s\n" % (j, j, j, cores_per_node,
+                                           _hhmmss(walltime),
+                                           _hhmmss(rand.randint(0, walltime)),
+                                           exec_host))
+                else:
+                    f.write("%d.server bench default job%d -- 1 %d -- %s "
+                            "Q -- --\n" % (j, j, rand.randint(1, 8),
+                                           _hhmmss(walltime)))
+        return [node_name(i) for i in range(num_nodes)]
+
+    def count_calls(self):
+        counts = {}
+        with open(self.calls_file) as f:
+            for line in f:
+                name = line.split(" ", 1)[0]
+                counts[name] = counts.get(name, 0) + 1
+        return counts
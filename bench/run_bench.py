@@ -0,0 +1,215 @@
+"""Drives Phorque against a fake Torque cluster and a local stand-in for
+the EC2/autoscale APIs, measuring each phase of the main loop.
+
+Run from the top of the tree, e.g.:
+
+    python -m bench.run_bench --nodes 10000 --jobs 100000 --label 0.1
+"""
+import gc
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from ConfigParser import SafeConfigParser
+from optparse import OptionParser
+
+from bench.fake_cloud import FakeCloudServer
+from bench.fake_cloud import FakeCloudState
+from bench.fake_torque import FakeTorque
+from bench.fake_torque import node_name
+from cloud.clouds import Clouds
+from cluster.torque import TorqueCluster
+from lib.logger import configure_logging
+from policy import policies
+
+
+LOG = logging.getLogger(__name__)
+CLOUD_NAME = "Cloud-Bench"
+PHASES = ["cluster.update", "clouds.refresh_all", "policy.execute"]
+
+
+def parse_options():
+    parser = OptionParser()
+    parser.add_option("--nodes", action="store", type="int", dest="nodes",
+                      help="Number of nodes in the fake cluster.")
+    parser.add_option("--jobs", action="store", type="int", dest="jobs",
+                      help="Number of jobs in the fake queue.")
+    parser.add_option("--iterations", action="store", type="int",
+                      dest="iterations", help="Number of loop iterations.")
+    parser.add_option("--policy", action="store", dest="policy",
+                      help="Name of the policy to execute.")
+    parser.add_option("--label", action="store", dest="label",
+                      help="Release or revision the results belong to.")
+    parser.add_option("--output", action="store", dest="output",
+                      help="File results are appended to, one JSON per line.")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug",
+                      help="Enable debugging log level.")
+    parser.set_defaults(nodes=10000, jobs=100000, iterations=3,
+                        policy="OnDemandPlusPlus", label="dev",
+                        output=os.path.join(os.path.dirname(__file__),
+                                            "results.jsonl"),
+                        debug=False)
+    return parser.parse_args()
+
+
+def make_config(cluster_directory, port, max_instances):
+    config = SafeConfigParser()
+    config.add_section("Phorque")
+    config.set("Phorque", "loop_sleep_secs", "0")
+    config.set("Phorque", "cluster_directory", cluster_directory)
+    config.set("Phorque", "queue_name", "default")
+    config.add_section("Policy")
+    config.set("Policy", "multiplier", "1")
+    config.set("Policy", "target_wait_secs", "600")
+    config.add_section(CLOUD_NAME)
+    for option, value in [("cloud_uri", "127.0.0.1"),
+                          ("cloud_port", str(port)),
+                          ("autoscale_uri", "127.0.0.1"),
+                          ("autoscale_port", str(port)),
+                          ("is_secure", "false"),
+                          ("image_id", "bench.gz"),
+                          ("price", "1"),
+                          ("access_id", "bench"),
+                          ("secret_key", "bench"),
+                          ("launch_config_name", "benchlc@bench"),
+                          ("autoscale_group_name", "benchasg"),
+                          ("cloud_type", "nimbus"),
+                          ("availability_zone", "us-east-1"),
+                          ("instance_type", "m1.large"),
+                          ("instance_cores", "2"),
+                          ("max_instances", str(max_instances)),
+                          ("charge_time_secs", "3600")]:
+        config.set(CLOUD_NAME, option, value)
+    return config
+
+
+def _diff_counts(after, before):
+    return dict((k, v - before.get(k, 0)) for k, v in after.items()
+                if v - before.get(k, 0))
+
+
+def _current_rss_kb():
+    """Resident set size now, unlike ru_maxrss which never goes down."""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def _measure(name, func, torque, state, results):
+    calls_before = torque.count_calls()
+    api_before = dict(state.calls)
+    gc.collect()
+    rss_before = _current_rss_kb()
+    objects_before = len(gc.get_objects())
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    phase = results.setdefault(name, {"secs": [], "subprocess_calls": {},
+                                      "api_calls": {}, "rss_kb_delta": [],
+                                      "gc_objects_delta": []})
+    phase["secs"].append(elapsed)
+    # objects still referenced after the phase, i.e. what it keeps alive
+    gc.collect()
+    phase["rss_kb_delta"].append(_current_rss_kb() - rss_before)
+    phase["gc_objects_delta"].append(len(gc.get_objects()) - objects_before)
+    phase["subprocess_calls"] = _diff_counts(torque.count_calls(),
+                                             calls_before)
+    phase["api_calls"] = _diff_counts(dict(state.calls), api_before)
+
+
+def run(options):
+    directory = tempfile.mkdtemp(prefix="phorque-bench-")
+    try:
+        torque = FakeTorque(directory, python=sys.executable)
+        LOG.info("Generating %d nodes and %d jobs in %s" % (
+            options.nodes, options.jobs, directory))
+        torque.generate(options.nodes, options.jobs)
+        state = FakeCloudState(node_name)
+        state.seed_group("benchasg", "benchlc@bench", "us-east-1",
+                         options.nodes)
+        server = FakeCloudServer(state)
+        server.start()
+        config = make_config(directory, server.server_address[1],
+                             options.nodes * 2)
+
+        results = {}
+        start = time.time()
+        cluster = TorqueCluster(directory)
+        clouds = Clouds([CLOUD_NAME], config)
+        results["setup"] = {"secs": [time.time() - start],
+                            "api_calls": dict(state.calls)}
+        policy = getattr(policies, options.policy)()
+        rss = []
+        for i in range(options.iterations):
+            LOG.info("Iteration %d" % i)
+            _measure(PHASES[0], cluster.update, torque, state, results)
+            _measure(PHASES[1], lambda: clouds.refresh_all(cluster), torque,
+                     state, results)
+            _measure(PHASES[2], lambda: policy.execute(cluster, clouds),
+                     torque, state, results)
+            rss.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        server.shutdown()
+        return {"label": options.label,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "nodes": options.nodes,
+                "jobs": options.jobs,
+                "policy": options.policy,
+                "iterations": options.iterations,
+                "max_rss_kb": rss,
+                "gc_objects": len(gc.get_objects()),
+                "phases": results}
+    finally:
+        shutil.rmtree(directory)
+
+
+def previous_result(output, result):
+    if not os.path.exists(output):
+        return None
+    previous = None
+    with open(output) as f:
+        for line in f:
+            record = json.loads(line)
+            if ((record["nodes"], record["jobs"], record["policy"]) ==
+                    (result["nodes"], result["jobs"], result["policy"])):
+                previous = record
+    return previous
+
+
+def report(result, previous):
+    print("%-20s %10s %10s %10s %10s  %s" % (
+        "phase", "mean secs", "previous", "rss KB", "objects",
+        "subprocess / api calls (last)"))
+    for name in ["setup"] + PHASES:
+        phase = result["phases"][name]
+        mean = sum(phase["secs"]) / len(phase["secs"])
+        before = ""
+        if previous and name in previous["phases"]:
+            secs = previous["phases"][name]["secs"]
+            before = "%.3f" % (sum(secs) / len(secs))
+        rss = phase.get("rss_kb_delta", [0])
+        objects = phase.get("gc_objects_delta", [0])
+        print("%-20s %10.3f %10s %+10d %+10d  %s %s" % (
+            name, mean, before, sum(rss) // len(rss),
+            sum(objects) // len(objects), phase.get("subprocess_calls", {}),
+            phase["api_calls"]))
+    print("rss KB and objects are mean per-phase deltas")
+    print("max rss (KB) per iteration: %s" % result["max_rss_kb"])
+
+
+def main():
+    (options, args) = parse_options()
+    configure_logging(options.debug)
+    result = run(options)
+    previous = previous_result(options.output, result)
+    report(result, previous)
+    with open(options.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
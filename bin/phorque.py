@@ -2,36 +2,163 @@ import logging
 import os
 import signal
 import sys
-import time
 
 from cloud.clouds import Clouds
+from cluster.readiness import ReadinessServer
 from cluster.torque import TorqueCluster
+from lib.config import CloudConfig
+from lib.lease import Lease
+from lib.lease import LeaseKeeper
 from lib.logger import configure_logging
 from lib.util import parse_options
 from lib.util import read_config
 from policy import policies
+from policy.shadow import ShadowRunner
+from threading import Event
 from threading import Thread
 
 
 SIGEXIT = False
+SIGRELOAD = False
 STATIC_CONFIG_SECTIONS = ["Phorque", "Policy"]
 LOG = logging.getLogger(__name__)
 
 
 class Phorque(Thread):
-    def __init__(self, config):
+    def __init__(self, config, config_file=None):
         Thread.__init__(self)
         self.config = config
+        self.config_file = config_file
+        self._config_mtime = self._get_config_mtime()
         self.loop_sleep_secs = config.getint("Phorque", "loop_sleep_secs")
         self.cluster_directory = config.get("Phorque", "cluster_directory")
-        self.cloud_names = list(set(config.sections()) -
-                                set(STATIC_CONFIG_SECTIONS))
-        self.policy_name = config.get("Policy", "name")
-        Policy = getattr(policies, self.policy_name)
-        self.policy = Policy()
+        self.use_accounting = False
+        if config.has_option("Phorque", "job_source"):
+            job_source = config.get("Phorque", "job_source")
+            self.use_accounting = (job_source == "accounting")
+        self.full_scan_secs = 600
+        if config.has_option("Phorque", "full_scan_secs"):
+            self.full_scan_secs = config.getint("Phorque", "full_scan_secs")
+        self.cloud_names = self._get_cloud_names(config)
+        self.readiness_port = None
+        if config.has_option("Phorque", "readiness_port"):
+            self.readiness_port = config.getint("Phorque", "readiness_port")
+        self.readiness_address = "127.0.0.1"
+        if config.has_option("Phorque", "readiness_address"):
+            self.readiness_address = config.get("Phorque",
+                                                "readiness_address")
+        self.readiness_token = None
+        if config.has_option("Phorque", "readiness_token"):
+            self.readiness_token = config.get("Phorque", "readiness_token")
+        self.lease = None
+        if config.has_option("Phorque", "lease_file"):
+            lease_ttl_secs = 15
+            if config.has_option("Phorque", "lease_ttl_secs"):
+                lease_ttl_secs = config.getint("Phorque", "lease_ttl_secs")
+            self.lease = Lease(config.get("Phorque", "lease_file"),
+                               lease_ttl_secs)
+        self._keeper = None
+        self._wake = Event()
+        self._load_policies(config)
+
+    def _get_cloud_names(self, config):
+        return list(set(config.sections()) - set(STATIC_CONFIG_SECTIONS))
+
+    def _get_config_mtime(self):
+        if self.config_file is None:
+            return None
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def _create_policy(self, config, name):
+        policy = getattr(policies, name)()
+        policy.configure(config)
+        return policy
+
+    def _create_policies(self, config, loop_sleep_secs):
+        """Returns the policy name, the policy and the shadow runner, or
+        raises an error if any of them cannot be set up from config."""
+        policy_name = config.get("Policy", "name")
+        policy = self._create_policy(config, policy_name)
+        shadow = None
+        if config.has_option("Policy", "shadow_names"):
+            shadow_names = config.get("Policy", "shadow_names").split(",")
+            shadow_policies = [self._create_policy(config, name.strip())
+                               for name in shadow_names if name.strip()]
+            if shadow_policies:
+                shadow = ShadowRunner(self._create_policy(config,
+                                                          policy_name),
+                                      shadow_policies, loop_sleep_secs)
+        return (policy_name, policy, shadow)
+
+    def _load_policies(self, config):
+        (self.policy_name, self.policy, self.shadow) = self._create_policies(
+            config, self.loop_sleep_secs)
+
+    def _reload(self, clouds):
+        LOG.info("Reloading %s" % self.config_file)
+        config = read_config(self.config_file)
+        cloud_names = self._get_cloud_names(config)
+        # fail before applying anything if the new config is incomplete
+        loop_sleep_secs = config.getint("Phorque", "loop_sleep_secs")
+        for name in cloud_names:
+            CloudConfig(name, config)
+        policies_changed = (dict(config.items("Policy")) !=
+                            dict(self.config.items("Policy")))
+        if policies_changed:
+            (policy_name, policy, shadow) = self._create_policies(
+                config, loop_sleep_secs)
+        old_options = dict(self.config.items("Phorque"))
+        new_options = dict(config.items("Phorque"))
+        changed = [option for option in set(old_options) | set(new_options)
+                   if old_options.get(option) != new_options.get(option)
+                   and option != "loop_sleep_secs"]
+        if changed:
+            LOG.warn("Restart to apply changes to [Phorque]: %s" % (
+                sorted(changed)))
+        clouds.reconfigure(cloud_names, config)
+        if loop_sleep_secs != self.loop_sleep_secs:
+            self.loop_sleep_secs = loop_sleep_secs
+            LOG.info("Loop sleep is now %s seconds" % self.loop_sleep_secs)
+        if policies_changed:
+            (self.policy_name, self.policy, self.shadow) = (policy_name,
+                                                            policy, shadow)
+            LOG.info("Swapped in the %s policy" % self.policy_name)
+        if self.shadow:
+            self.shadow.loop_sleep_secs = self.loop_sleep_secs
+        self.cloud_names = cloud_names
+        self.config = config
+
+    def _maybe_reload(self, clouds):
+        global SIGRELOAD
+        mtime = self._get_config_mtime()
+        if not SIGRELOAD and mtime == self._config_mtime:
+            return
+        SIGRELOAD = False
+        self._config_mtime = mtime
+        try:
+            self._reload(clouds)
+        except Exception as e:
+            LOG.error("Error reloading the config, keeping the old one: %s" % (
+                str(e)))
+
+    def _beat(self):
+        if self._keeper is not None:
+            # an iteration may run for a whole sleep before the next beat
+            self._keeper.beat(2 * self.loop_sleep_secs + self.lease.ttl_secs)
+
+    def _is_active(self):
+        return self.lease is None or self.lease.is_held()
 
     def _loop(self, cluster, clouds):
         while not SIGEXIT:
+            self._beat()
+            if self.config_file is not None:
+                # between iterations, so a policy is never swapped mid-run
+                self._maybe_reload(clouds)
+            active = self._is_active()
             try:
                 LOG.debug("Attempting to update cluster information")
                 cluster.update()
@@ -40,23 +167,51 @@ class Phorque(Thread):
                 LOG.error("Error updating cluster information: %s" % str(e))
             try:
                 LOG.debug("Refreshing all clouds")
-                clouds.refresh_all(cluster)
+                # a standby keeps its state current without touching the
+                # cluster
+                clouds.refresh_all(cluster, update_cluster=active)
                 LOG.info("Successfully refreshed all clouds")
             except Exception as e:
                 LOG.error("Error refreshing cloud information: %s" % str(e))
+            if active:
+                self._execute_policies(cluster, clouds)
+            else:
+                try:
+                    clouds.set_state(self.lease.read_state())
+                    LOG.info("Standby, replicated state from %s" % (
+                        self.lease.path))
+                except Exception as e:
+                    LOG.error("Error replicating state: %s" % str(e))
+            LOG.info("Sleeping for %s seconds" % self.loop_sleep_secs)
+            # woken early when this process takes over the lease
+            self._wake.wait(self.loop_sleep_secs)
+            self._wake.clear()
+
+    def _execute_policies(self, cluster, clouds):
+        if self.shadow:
             try:
-                LOG.debug("Executing the policy")
-                self.policy.execute(cluster, clouds)
-                LOG.info("Successfully executed the policy")
+                LOG.debug("Evaluating shadow policies")
+                self.shadow.execute(cluster, clouds)
             except Exception as e:
-                LOG.error("Error executing the policy: %s" % str(e))
-            LOG.info("Sleeping for %s seconds" % self.loop_sleep_secs)
-            time.sleep(self.loop_sleep_secs)
+                LOG.error("Error evaluating shadow policies: %s" % str(e))
+        try:
+            LOG.debug("Executing the policy")
+            self.policy.execute(cluster, clouds)
+            LOG.info("Successfully executed the policy")
+        except Exception as e:
+            LOG.error("Error executing the policy: %s" % str(e))
+        if self.lease is not None:
+            try:
+                self.lease.publish(clouds.get_state())
+            except Exception as e:
+                LOG.error("Error publishing state: %s" % str(e))
 
     def run(self):
         LOG.debug("Configuring cluster: %s" % self.cluster_directory)
         if os.path.exists(self.cluster_directory):
-            cluster = TorqueCluster(self.cluster_directory)
+            cluster = TorqueCluster(self.cluster_directory,
+                                    use_accounting=self.use_accounting,
+                                    full_scan_secs=self.full_scan_secs)
         else:
             LOG.error("Directory not found: %s" % self.cluster_directory)
             cluster = None
@@ -68,8 +223,32 @@ class Phorque(Thread):
             LOG.error("Please verify that the config file is correct.")
             LOG.error("Output: %s" % str(e))
             clouds = None
+        if (cluster and self.readiness_port and
+                self.readiness_token is None and
+                not self.readiness_address.startswith("127.")):
+            LOG.error("readiness_token is required to listen for readiness "
+                      "callbacks on %s" % self.readiness_address)
+        elif cluster and self.readiness_port:
+            try:
+                ReadinessServer(cluster, address=self.readiness_address,
+                                port=self.readiness_port,
+                                token=self.readiness_token,
+                                fence=self._is_active).start()
+            except Exception as e:
+                LOG.error("Unable to listen for readiness callbacks: %s" % (
+                    str(e)))
         if cluster and clouds:
+            if self.lease is not None:
+                clouds.set_fence(self.lease.is_held)
+                self.lease.acquire()
+                self._keeper = LeaseKeeper(self.lease, self._wake)
+                self._beat()
+                self._keeper.start()
             self._loop(cluster, clouds)
+            if self.lease is not None:
+                # let the standby take over right away
+                self._keeper.stopped.set()
+                self.lease.release()
         else:
             LOG.error("Unable to start. Please fix your setup.")
 
@@ -80,12 +259,19 @@ def clean_exit(signum, frame):
     LOG.critical("Exiting at the next possible time. Please stand by.")
 
 
+def reload_config(signum, frame):
+    global SIGRELOAD
+    SIGRELOAD = True
+    LOG.info("Reloading the config at the next iteration.")
+
+
 def main():
     (options, args) = parse_options()
     configure_logging(options.debug)
     config = read_config(options.config_file)
     signal.signal(signal.SIGINT, clean_exit)
-    phorque = Phorque(config)
+    signal.signal(signal.SIGHUP, reload_config)
+    phorque = Phorque(config, options.config_file)
     LOG.info("Starting Phorque thread")
     phorque.daemon = True
     phorque.start()
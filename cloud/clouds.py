@@ -3,6 +3,7 @@ import datetime
 import json
 import logging
 import os
+import threading
 import time
 
 from boto.ec2.autoscale import AutoScaleConnection
@@ -12,6 +13,8 @@ from boto.ec2.autoscale.launchconfig import LaunchConfiguration
 from boto.regioninfo import RegionInfo
 from lib.config import CloudConfig
 from lib.config import VALID_RUN_STATES
+from lib.config import WARM_POOL_STATES
+from lib.lease import FencedError
 from lib.util import Command
 from lib.util import read_file
 from lib.util import write_file
@@ -20,12 +23,46 @@ from lib.util import write_file
 # supress most boto logging
 logging.getLogger('boto').setLevel(logging.CRITICAL)
 LOG = logging.getLogger(__name__)
+TIME_FMT = "%Y-%m-%dT%H:%M:%S.%fZ"
+# changing any of these means reconnecting to the cloud
+CONNECTION_OPTIONS = ["cloud_uri", "cloud_port", "autoscale_uri",
+                      "autoscale_port", "is_secure", "access_id",
+                      "secret_key", "cloud_type", "launch_config_name",
+                      "autoscale_group_name", "availability_zone"]
+# changing any of these points the cloud at a different autoscale group
+ASG_IDENTITY_OPTIONS = ["autoscale_uri", "autoscale_port", "cloud_type",
+                        "autoscale_group_name"]
+# an existing launch configuration is loaded by name and never modified
+LC_CONTENT_OPTIONS = ["image_id", "instance_type", "user_data_file"]
+
+
+class Instance(object):
+    """The fields Phorque uses from a boto Instance."""
+    __slots__ = ["id", "public_dns_name", "state", "launch_time", "cores"]
+
+    def __init__(self, instance, cores):
+        self.id = instance.id
+        self.launch_time = datetime.datetime.strptime(instance.launch_time,
+                                                      TIME_FMT)
+        self.cores = cores
+        self.update(instance)
+
+    def update(self, instance):
+        self.public_dns_name = instance.public_dns_name
+        self.state = instance.state
+
+    def __repr__(self):
+        return "Instance<%s, %s, %s>" % (self.id, self.public_dns_name,
+                                         self.state)
 
 
 class Cloud(object):
     def __init__(self, cloud_config):
         self.config = cloud_config
         self.all_instances = []
+        self._instances_by_id = {}
+        # ids of stopped autoscale group instances kept for fast scale-up
+        self.warm_pool = set()
         self.failed_launch = False
         self.failed_count = 0
         self.failed_last_valid_count = 0
@@ -35,6 +72,12 @@ class Cloud(object):
         self._asg = None
         self._last_asg_launch_attempt = None
         self.maxed = False
+        # set when the cloud is removed from the config, no more instances
+        # are launched and it is dropped once it has none left
+        self.draining = False
+        # checked before changing capacity, false once another Phorque
+        # process has taken over
+        self.fence = None
         self._last_launch_attempt = datetime.datetime.utcnow()
         self._initialize()
 
@@ -42,6 +85,7 @@ class Cloud(object):
         LOG.debug("Creating connection for %s" % self.config.name)
         self._conn = boto.connect_ec2(self.config.access_id,
                                       self.config.secret_key,
+                                      is_secure=self.config.is_secure,
                                       validate_certs=False)
         self._conn.host = self.config.cloud_uri
         self._conn.port = self.config.cloud_port
@@ -53,7 +97,7 @@ class Cloud(object):
         self._as_conn = AutoScaleConnection(
             aws_access_key_id=self.config.access_id,
             aws_secret_access_key=self.config.secret_key,
-            is_secure=True,
+            is_secure=self.config.is_secure,
             port=self.config.as_port,
             region=region,
             validate_certs=False)
@@ -131,6 +175,18 @@ class Cloud(object):
                                          tags=tags)
             self._as_conn.create_auto_scaling_group(self._asg)
 
+    def update_launch_configuration(self):
+        """Switches the autoscale group to the configured launch
+        configuration. Only the active Phorque may do this, so it is not
+        part of initialization."""
+        if self._asg.launch_config_name == self._lc.name:
+            return
+        self._check_fence()
+        LOG.info("Switching autoscale group %s to launch configuration %s" % (
+            self.config.asg_name, self._lc.name))
+        self._asg.launch_config_name = self._lc.name
+        self._asg.update()
+
     def _initialize(self):
         LOG.debug("Initializing %s" % self.config.name)
         self._create_connection()
@@ -144,21 +200,36 @@ class Cloud(object):
 
     def _refresh_instances(self):
         LOG.debug("%s: getting instance information" % self.config.name)
-        self.all_instances = []
+        # Instance records are kept between polls and updated in place. When
+        # it is turned on, the warm pool is rebuilt from the stopped group
+        # members each time, so it survives restarts and instances stopped
+        # outside of Phorque.
         instances = []
-        as_instances = self._asg.instances
-        as_instance_ids = [i.instance_id for i in as_instances]
+        instances_by_id = {}
+        warm_pool = set()
+        as_instance_ids = set(i.instance_id for i in self._asg.instances)
         reservations = self._conn.get_all_instances()
         for reservation in reservations:
             for instance in reservation.instances:
                 if instance.id in as_instance_ids:
-                    if instance.state in VALID_RUN_STATES:
-                        instances.append(instance)
-        for instance in instances:
-            self.all_instances.append(instance)
+                    if instance.state in WARM_POOL_STATES:
+                        if self.config.warm_pool_size > 0:
+                            warm_pool.add(instance.id)
+                    elif instance.state in VALID_RUN_STATES:
+                        record = self._instances_by_id.get(instance.id)
+                        if record is None:
+                            record = Instance(instance,
+                                              self.config.instance_cores)
+                        else:
+                            record.update(instance)
+                        instances.append(record)
+                        instances_by_id[instance.id] = record
+        self.all_instances = instances
+        self._instances_by_id = instances_by_id
+        self.warm_pool = warm_pool
         num_instances = len(self.all_instances)
-        LOG.debug("%s: updated %d instances" % (self.config.name,
-                                                num_instances))
+        LOG.debug("%s: updated %d instances, %d in the warm pool" % (
+            self.config.name, num_instances, len(self.warm_pool)))
         if num_instances >= self.config.max_instances:
             LOG.warn("%s reached the max (%s) instances: %s" % (
                 self.config.name, self.config.max_instances,
@@ -186,7 +257,7 @@ class Cloud(object):
         total_num_valid_cores = 0
         num_valid_instances = len(self.get_valid_instances())
         total_valid_cores = num_valid_instances * self.config.instance_cores
-        num_desired_instances = self._asg.desired_capacity
+        num_desired_instances = self.get_desired_capacity()
         num_desired_cores = num_desired_instances * self.config.instance_cores
         if num_desired_cores != total_num_valid_cores:
             LOG.debug("\tmismatching core counts")
@@ -194,31 +265,44 @@ class Cloud(object):
             LOG.debug("\ttotal_valid_cores: %d" % (total_valid_cores))
         return total_valid_cores
 
+    def get_desired_capacity(self):
+        """Desired capacity of the autoscale group not counting the
+        stopped instances in the warm pool."""
+        return self._asg.desired_capacity - len(self.warm_pool)
+
+    def get_warm_pool_limit(self, price_per_hour=None):
+        """Maximum size of the warm pool. When the pool has a price, it is
+        also limited to what price_per_hour can pay for."""
+        if self.draining:
+            return 0
+        limit = self.config.warm_pool_size
+        if self.config.warm_pool_price > 0 and price_per_hour is not None:
+            hourly_price = (self.config.warm_pool_price * 3600.0 /
+                            self.config.charge_time_secs)
+            limit = min(limit, int(price_per_hour / hourly_price))
+        return max(limit, 0)
+
     def get_instance_by_id(self, id):
         LOG.debug("Searching for instance %s" % id)
-        for instances in self.all_instances:
-            if instance.id == id:
-                LOG.debug("Found instance %s" % id)
-                return instance
-        return None
+        instance = self._instances_by_id.get(id)
+        if instance is not None:
+            LOG.debug("Found instance %s" % id)
+        return instance
 
     def get_instance_ids_for_public_dns_names(self, public_dns_names):
+        public_dns_names = set(public_dns_names)
         instance_ids = []
         for instance in self.all_instances:
             if instance.public_dns_name in public_dns_names:
                 instance_ids.append(instance.id)
         return instance_ids
 
-    def get_public_dns_names_close_to_charge(self):
-        instances_close_to_charge = []
-        sleep_secs = self.config.get_loop_sleep_secs()
+    def get_secs_to_charge_by_public_dns_name(self):
+        secs_to_charge_by_name = {}
         cur_utc_time = datetime.datetime.utcnow()
         valid_instances = self.get_valid_instances()
-        time_fmt = "%Y-%m-%dT%H:%M:%S.%fZ"
         for instance in valid_instances:
-            launch_time = datetime.datetime.strptime(instance.launch_time,
-                                                     time_fmt)
-            time_diff = cur_utc_time - launch_time
+            time_diff = cur_utc_time - instance.launch_time
             # Ignores microseconds
             time_diff_secs = time_diff.seconds + time_diff.days * 24 * 3600
             cur_charge_secs = time_diff_secs % self.config.charge_time_secs
@@ -227,31 +311,75 @@ class Cloud(object):
                 instance.id, instance.public_dns_name,
                 self.config.charge_time_secs,
                 cur_charge_secs, secs_to_charge))
-            if secs_to_charge < (3 * sleep_secs):
-                instances_close_to_charge.append(instance.public_dns_name)
+            secs_to_charge_by_name[instance.public_dns_name] = secs_to_charge
+        return secs_to_charge_by_name
+
+    def get_public_dns_names_close_to_charge(self):
+        instances_close_to_charge = []
+        sleep_secs = self.config.get_loop_sleep_secs()
+        secs_to_charge_by_name = self.get_secs_to_charge_by_public_dns_name()
+        for public_dns_name, secs in secs_to_charge_by_name.items():
+            if secs < (3 * sleep_secs):
+                instances_close_to_charge.append(public_dns_name)
         return instances_close_to_charge
 
+    def _check_fence(self):
+        if self.fence is not None and not self.fence():
+            raise FencedError("%s: not the active Phorque, refusing to "
+                              "change capacity" % self.config.name)
+
     def delete_instances(self, instance_ids=[]):
         if not instance_ids:
             return
+        self._check_fence()
         LOG.debug("Deleting instances: %s" % instance_ids)
         # TODO(pdmars): this has the potential to kill instances running jobs
         # maybe I should err on the side of having extra instances if the
         # capacity is higher than the cloud can currently support
         num_instances = len(self.all_instances)
-        if ((self._asg.desired_capacity > num_instances) and
+        if ((self.get_desired_capacity() > num_instances) and
                 (num_instances > 0)):
             LOG.warn("Desired capacity is greater than num_instances running")
             LOG.warn("Adjusting desired capacity to match")
-            self.set_capacity(num_instances)
+            self.set_capacity(num_instances + len(self.warm_pool))
         for instance_id in instance_ids:
             self._as_conn.terminate_instance(instance_id)
+            self.warm_pool.discard(instance_id)
             # TODO(pdmars): due to a bug in phantom, maybe this will help
             # 2013/04/05: this might not be relevant anymore
             time.sleep(.1)
 
+    def stop_instances(self, instance_ids=[]):
+        """Moves instances into the warm pool instead of terminating them.
+
+        The instances stay in the autoscale group, so this relies on the
+        cloud not replacing stopped group members.
+        """
+        if not instance_ids:
+            return
+        self._check_fence()
+        LOG.debug("Stopping instances for the warm pool: %s" % instance_ids)
+        self._conn.stop_instances(instance_ids)
+        self.warm_pool.update(instance_ids)
+
+    def start_instances(self, instance_ids=[]):
+        if not instance_ids:
+            return
+        self._check_fence()
+        LOG.debug("Starting instances from the warm pool: %s" % instance_ids)
+        self._conn.start_instances(instance_ids)
+        self.warm_pool.difference_update(instance_ids)
+
     def launch_autoscale_instances(self, num_instances=1):
-        new_capacity = self._asg.desired_capacity + int(num_instances)
+        num_instances = int(num_instances)
+        warm_ids = sorted(self.warm_pool)[:num_instances]
+        if warm_ids:
+            self._last_launch_attempt = datetime.datetime.utcnow()
+            self.start_instances(warm_ids)
+            num_instances -= len(warm_ids)
+        if num_instances <= 0:
+            return
+        new_capacity = self._asg.desired_capacity + num_instances
         if new_capacity > self.config.max_instances:
             new_capacity = self.config.max_instances
             LOG.warn("%s can launch %s total instances" % (self.config.name,
@@ -262,8 +390,20 @@ class Cloud(object):
         self.set_capacity(new_capacity)
 
     def set_capacity(self, new_capacity):
+        self._check_fence()
         self._asg.set_capacity(new_capacity)
 
+    def get_state(self):
+        return {"failed_launch": self.failed_launch,
+                "failed_count": self.failed_count,
+                "failed_last_valid_count": self.failed_last_valid_count}
+
+    def set_state(self, state):
+        self.failed_launch = state.get("failed_launch", False)
+        self.failed_count = state.get("failed_count", 0)
+        self.failed_last_valid_count = state.get("failed_last_valid_count",
+                                                 0)
+
 
 class Clouds(object):
     def __init__(self, cloud_names, global_config):
@@ -272,13 +412,18 @@ class Clouds(object):
         self.clouds = {}
         self._clouds_low_to_high = []
         self._instances_out_of_date = []
+        self._draining_clouds = []
+        self._initializing = set()
+        self._initialized = []
+        self._lock = threading.Lock()
+        self._fence = None
         self._initialize()
 
     def _create_cloud_from_config(self, name):
         return Cloud(CloudConfig(name, self._global_config))
 
     def _get_clouds_ordered_by_price(self, descending=False):
-        clouds = self.clouds.values()
+        clouds = list(self.clouds.values()) + self._draining_clouds
         sorted_clouds = sorted(clouds, key=lambda x: x.config.price,
                                reverse=descending)
         return sorted_clouds
@@ -291,10 +436,136 @@ class Clouds(object):
         LOG.debug("Sorting clouds by price (low to high)")
         self._clouds_low_to_high = self._get_clouds_ordered_by_price()
 
+    def _initialize_in_background(self, name):
+        def initialize():
+            try:
+                cloud = self._create_cloud_from_config(name)
+            except Exception as e:
+                LOG.error("Unable to initialize %s: %s" % (name, str(e)))
+                cloud = None
+            with self._lock:
+                self._initializing.discard(name)
+                if cloud is not None:
+                    self._initialized.append(cloud)
+
+        self._initializing.add(name)
+        thread = threading.Thread(target=initialize)
+        thread.daemon = True
+        thread.start()
+
+    def _add_initialized_clouds(self):
+        with self._lock:
+            initialized = self._initialized
+            self._initialized = []
+        for cloud in initialized:
+            name = cloud.config.name
+            if name not in self.cloud_names:
+                LOG.debug("%s was removed while initializing" % name)
+                continue
+            if (self._get_changed_options(cloud, self._global_config) &
+                    set(CONNECTION_OPTIONS)):
+                LOG.debug("%s changed while initializing" % name)
+                self._initialize_in_background(name)
+                continue
+            old = self.clouds.get(name)
+            if old is not None:
+                cloud.set_state(old.get_state())
+            cloud.fence = self._fence
+            self.clouds[name] = cloud
+            LOG.info("%s is ready" % name)
+        if initialized:
+            self._clouds_low_to_high = self._get_clouds_ordered_by_price()
+
+    def _retire_drained_clouds(self):
+        for cloud in list(self._draining_clouds):
+            if cloud.all_instances or cloud.warm_pool:
+                LOG.debug("%s still has %d instances" % (
+                    cloud.config.name, len(cloud.all_instances)))
+                continue
+            if cloud._asg.desired_capacity > 0:
+                cloud.set_capacity(0)
+            LOG.info("%s has drained, removing it" % cloud.config.name)
+            self._draining_clouds.remove(cloud)
+        self._clouds_low_to_high = self._get_clouds_ordered_by_price()
+
+    def _drain(self, name):
+        cloud = self.clouds.pop(name, None)
+        if cloud is not None:
+            cloud.draining = True
+            self._draining_clouds.append(cloud)
+
+    def _get_changed_options(self, cloud, global_config):
+        name = cloud.config.name
+        old_options = dict(cloud.config._config.items(name))
+        new_options = dict(global_config.items(name))
+        return set(option for option in set(old_options) | set(new_options)
+                   if old_options.get(option) != new_options.get(option))
+
+    def _revive_draining_cloud(self, name, global_config):
+        """Puts a cloud that was removed and added back before it drained
+        back in service, if it still uses the same autoscale group."""
+        for cloud in self._draining_clouds:
+            if cloud.config.name != name:
+                continue
+            if (self._get_changed_options(cloud, global_config) &
+                    set(ASG_IDENTITY_OPTIONS)):
+                continue
+            LOG.info("%s was added back while draining, reviving it" % name)
+            self._draining_clouds.remove(cloud)
+            cloud.draining = False
+            self.clouds[name] = cloud
+            return cloud
+        return None
+
+    def reconfigure(self, cloud_names, global_config):
+        """Applies a reloaded config. New clouds and clouds whose connection
+        changed are initialized in the background, removed clouds and clouds
+        that now use another autoscale group drain and other changes take
+        effect right away."""
+        self._global_config = global_config
+        for name in set(self.cloud_names) - set(cloud_names):
+            if name in self.clouds:
+                LOG.info("%s was removed, draining it" % name)
+                self._drain(name)
+        for name in cloud_names:
+            cloud = self.clouds.get(name)
+            if cloud is None:
+                cloud = self._revive_draining_cloud(name, global_config)
+            if cloud is None:
+                if name not in self._initializing:
+                    LOG.info("%s was added, initializing it" % name)
+                    self._initialize_in_background(name)
+                continue
+            changed = self._get_changed_options(cloud, global_config)
+            if changed & set(ASG_IDENTITY_OPTIONS):
+                LOG.info("%s autoscale group changed, draining the old one" % (
+                    name))
+                self._drain(name)
+                cloud = self._revive_draining_cloud(name, global_config)
+                if cloud is None:
+                    if name not in self._initializing:
+                        self._initialize_in_background(name)
+                    continue
+                changed = self._get_changed_options(cloud, global_config)
+            if changed & set(LC_CONTENT_OPTIONS) and not (
+                    "launch_config_name" in changed):
+                LOG.warn("%s: %s only apply with a new launch_config_name" % (
+                    name, sorted(changed & set(LC_CONTENT_OPTIONS))))
+            if (changed & set(CONNECTION_OPTIONS) and
+                    name not in self._initializing):
+                LOG.info("%s connection changed, reinitializing it" % name)
+                self._initialize_in_background(name)
+            cloud.config = CloudConfig(name, global_config)
+            if changed:
+                LOG.info("%s changed: %s" % (name, sorted(changed)))
+        self.cloud_names = cloud_names
+        self._clouds_low_to_high = self._get_clouds_ordered_by_price()
+
     def get_cheapest_valid_cloud(self):
         clouds = self._clouds_low_to_high
         for cloud in clouds:
-            if (not cloud.failed_launch) and (not cloud.maxed):
+            if ((not cloud.failed_launch) and (not cloud.maxed) and
+                    (not cloud.draining)):
                 return cloud
 
     def get_clouds_low_to_high(self):
@@ -308,11 +579,11 @@ class Clouds(object):
 
     def _update_cluster_instances(self, cluster):
         out_of_date = []
-        cloud_dns_names = []
+        cloud_dns_names = set()
         clouds = self.get_clouds_low_to_high()
         for cloud in clouds:
             for instance in cloud.all_instances:
-                cloud_dns_names.append(instance.public_dns_name)
+                cloud_dns_names.add(instance.public_dns_name)
         for node in cluster.nodes:
             if node.public_dns_name not in cloud_dns_names:
                 LOG.debug("%s appears out of date" % node.public_dns_name)
@@ -333,9 +604,32 @@ class Clouds(object):
             for instance in cloud.all_instances:
                 if instance.public_dns_name:
                     cluster.add_node(instance.public_dns_name,
-                                     cloud.config.instance_cores)
+                                     instance.cores)
+
+    def set_fence(self, fence):
+        self._fence = fence
+        for cloud in self.get_clouds_low_to_high():
+            cloud.fence = fence
 
-    def refresh_all(self, cluster):
-        for cloud_name in self.clouds.keys():
-            self.clouds[cloud_name].refresh(cluster)
-        self._update_cluster_instances(cluster)
+    def get_state(self):
+        return dict((name, cloud.get_state())
+                    for name, cloud in self.clouds.items())
+
+    def set_state(self, state):
+        for name, cloud_state in state.items():
+            if name in self.clouds:
+                self.clouds[name].set_state(cloud_state)
+
+    def refresh_all(self, cluster, update_cluster=True):
+        self._add_initialized_clouds()
+        for cloud in self.get_clouds_low_to_high():
+            cloud.refresh(cluster)
+        if update_cluster:
+            for cloud in self.clouds.values():
+                try:
+                    cloud.update_launch_configuration()
+                except Exception as e:
+                    LOG.error("Unable to update the launch configuration "
+                              "of %s: %s" % (cloud.config.name, str(e)))
+            self._update_cluster_instances(cluster)
+            self._retire_drained_clouds()
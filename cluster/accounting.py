@@ -0,0 +1,110 @@
+import logging
+import os
+import time
+
+
+LOG = logging.getLogger(__name__)
+TIME_FMT = "%m/%d/%Y %H:%M:%S"
+
+
+class AccountingEvent(object):
+    __slots__ = ["time", "type", "job_id", "attrs"]
+
+    def __init__(self, time, type, job_id, attrs):
+        self.time = time
+        self.type = type
+        self.job_id = job_id
+        self.attrs = attrs
+
+    def __repr__(self):
+        return "AccountingEvent<%s, %s>" % (self.type, self.job_id)
+
+
+class AccountingLog(object):
+    """Incrementally reads job records from server_priv/accounting.
+
+    Torque writes one accounting file per day, named YYYYMMDD. The log
+    remembers the file and offset it has read up to, finishes the old file
+    when a new one appears and starts over if a file is truncated or
+    replaced. Reading begins at the end of the newest file, earlier jobs are
+    expected to come from a full qstat scan.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, "server_priv/accounting")
+        self._filename = None
+        self._inode = None
+        self._offset = 0
+        LOG.debug("Set accounting directory: %s" % self.directory)
+        self.skip_to_end()
+
+    def _get_newest_filename(self):
+        try:
+            names = [name for name in os.listdir(self.directory)
+                     if name.isdigit()]
+        except OSError as e:
+            LOG.error("Unable to list accounting logs: %s" % str(e))
+            return None
+        if not names:
+            return None
+        return os.path.join(self.directory, max(names))
+
+    def skip_to_end(self):
+        self._filename = self._get_newest_filename()
+        if self._filename is None:
+            return
+        stat = os.stat(self._filename)
+        self._inode = stat.st_ino
+        self._offset = stat.st_size
+
+    def _parse_line(self, line):
+        parts = line.split(";", 3)
+        if len(parts) < 3:
+            return None
+        try:
+            event_time = time.mktime(time.strptime(parts[0], TIME_FMT))
+        except ValueError:
+            return None
+        attrs = {}
+        if len(parts) == 4:
+            for item in parts[3].split():
+                if "=" in item:
+                    (key, value) = item.split("=", 1)
+                    attrs[key] = value
+        return AccountingEvent(event_time, parts[1], parts[2], attrs)
+
+    def _read_file(self, filename, offset):
+        """Returns the events after offset and the offset of the first
+        incomplete line."""
+        events = []
+        with open(filename, "r") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind("\n") + 1
+        for line in data[:end].split("\n"):
+            event = self._parse_line(line)
+            if event is not None:
+                events.append(event)
+        return (events, offset + end)
+
+    def read_events(self):
+        events = []
+        newest = self._get_newest_filename()
+        if newest is None:
+            return events
+        if self._filename is not None and self._filename != newest:
+            # rotated, finish the previous day's file first
+            if os.path.exists(self._filename):
+                (events, offset) = self._read_file(self._filename,
+                                                   self._offset)
+            LOG.debug("Accounting log rotated to %s" % newest)
+            self._filename = None
+        stat = os.stat(newest)
+        if (self._filename is None or stat.st_ino != self._inode or
+                stat.st_size < self._offset):
+            self._filename = newest
+            self._inode = stat.st_ino
+            self._offset = 0
+        (new_events, self._offset) = self._read_file(newest, self._offset)
+        events += new_events
+        LOG.debug("Read %d accounting events" % len(events))
+        return events
@@ -0,0 +1,85 @@
+import logging
+import re
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+from urlparse import urlparse
+
+
+LOG = logging.getLogger(__name__)
+HOSTNAME_PATTERN = re.compile(r"^(?=.{1,253}$)[A-Za-z0-9]([A-Za-z0-9-]{0,61}"
+                              r"[A-Za-z0-9])?(\.[A-Za-z0-9]([A-Za-z0-9-]{0,61}"
+                              r"[A-Za-z0-9])?)*\Z")
+
+
+class ReadinessHandler(BaseHTTPRequestHandler):
+    def _respond(self, code, message):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.wfile.write(message + "\n")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/ready":
+            self._respond(404, "Not found")
+            return
+        if self.server.fence is not None and not self.server.fence():
+            self._respond(503, "Standby")
+            return
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if (self.server.token is not None and
+                params.get("token") != self.server.token):
+            LOG.warn("Rejected readiness callback from %s" % (
+                self.client_address[0]))
+            self._respond(403, "Forbidden")
+            return
+        public_dns_name = params.get("public_dns_name")
+        try:
+            np = int(params.get("np", 1))
+        except ValueError:
+            np = None
+        if not public_dns_name or not np or np < 1:
+            self._respond(400, "public_dns_name and np are required")
+            return
+        # the name ends up in a qmgr command line
+        if not HOSTNAME_PATTERN.match(public_dns_name):
+            LOG.warn("Rejected readiness callback with invalid name from %s" %
+                     self.client_address[0])
+            self._respond(400, "Invalid public_dns_name")
+            return
+        LOG.info("Node reported ready: %s" % public_dns_name)
+        if not self.server.cluster.register_ready_node(public_dns_name, np):
+            self._respond(500, "Unable to add node")
+            return
+        self._respond(200, "OK")
+
+    def log_message(self, format, *args):
+        LOG.debug("%s - %s" % (self.client_address[0], format % args))
+
+
+class ReadinessServer(ThreadingMixIn, HTTPServer):
+    """Lets booting instances join the cluster without waiting for the
+    next refresh. Instance user-data calls, for example:
+
+        curl "http://phorque:8446/ready?public_dns_name=$(hostname -f)&np=2"
+    """
+    daemon_threads = True
+
+    def __init__(self, cluster, address="127.0.0.1", port=8446, token=None,
+                 fence=None):
+        HTTPServer.__init__(self, (address, port), ReadinessHandler)
+        self.cluster = cluster
+        self.token = token
+        self.fence = fence
+
+    def start(self):
+        LOG.debug("Listening for readiness callbacks on %s:%s" % (
+            self.server_address))
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -1,24 +1,56 @@
 import logging
+import math
 import os
 import re
+import threading
+import time
 
+from cluster.accounting import AccountingLog
 from lib.util import Command
 
 
 LOG = logging.getLogger(__name__)
+# job ids per qstat lookup, keeps the command line well under ARG_MAX
+QSTAT_BATCH_SIZE = 100
 
 
 class Node(object):
+    __slots__ = ["public_dns_name", "np", "state", "terminate_me",
+                 "num_running_jobs", "secs_until_free"]
+
     def __init__(self, public_dns_name, np, state):
         self.public_dns_name = public_dns_name
+        self.update(np, state)
+
+    def update(self, np, state):
         self.np = np
         self.state = state
         self.terminate_me = False
+        self.num_running_jobs = 0
+        # None when the end of a running job cannot be estimated
+        self.secs_until_free = 0
 
     def __repr__(self):
         return "Node<%s, %s, %s>" % (self.public_dns_name, self.np, self.state)
 
 
+class Job(object):
+    __slots__ = ["id", "state", "cores", "exec_hosts", "end_time",
+                 "queued_since"]
+
+    def __init__(self, id, state, cores, queued_since=None):
+        self.id = id
+        self.state = state
+        self.cores = cores
+        self.exec_hosts = ()
+        # None when the end of a running job cannot be estimated
+        self.end_time = None
+        self.queued_since = queued_since
+
+    def __repr__(self):
+        return "Job<%s, %s, %s>" % (self.id, self.state, self.cores)
+
+
 class BaseCluster(object):
     def __init__(self):
         self.num_queued_jobs = 0
@@ -29,48 +61,201 @@ class BaseCluster(object):
         self.num_free_cores = 0
         self.num_down_cores = 0
         self.nodes = []
-        self._public_dns_names = []
-        self._has_booted = []
+        self._nodes_by_name = {}
+        self._public_dns_names = set()
+        self._has_booted = set()
+        # nodes marked offline while still running jobs
+        self._drained = set()
+        self._node_jobs = {}
+        self._jobs = {}
 
 
 class TorqueCluster(BaseCluster):
-    def __init__(self, directory):
+    def __init__(self, directory, use_accounting=False, full_scan_secs=600):
         super(TorqueCluster, self).__init__()
         self.directory = directory
-        self._qstat_cmd = os.path.join(self.directory, "bin/qstat -a")
+        self.full_scan_secs = full_scan_secs
+        self._last_full_scan = None
+        # the readiness listener adds nodes from its own threads
+        self._lock = threading.RLock()
+        self._accounting = None
+        if use_accounting:
+            self._accounting = AccountingLog(self.directory)
+        self._qstat_cmd = os.path.join(self.directory, "bin/qstat -a -n -1")
         self._pbsnodes_cmd = os.path.join(self.directory, "bin/pbsnodes")
         self._qmgr_cmd = os.path.join(self.directory, "bin/qmgr")
         LOG.debug("Set qstat command: %s" % self._qstat_cmd)
         LOG.debug("Set pbsnodes command: %s" % self._pbsnodes_cmd)
         LOG.debug("Set qmgr command: %s" % self._qmgr_cmd)
 
-    def _update_job_info(self):
-        qstat = Command([self._qstat_cmd])
+    def _parse_secs(self, hhmmss):
+        try:
+            secs = 0
+            for part in hhmmss.split(":"):
+                secs = secs * 60 + int(part)
+        except ValueError:
+            return None
+        if hhmmss.count(":") == 1:
+            # qstat shows HH:MM
+            secs *= 60
+        return secs
+
+    def _parse_exec_hosts(self, exec_host):
+        hosts = set()
+        for part in exec_host.split("+"):
+            host = part.split("/")[0]
+            if host and host != "--":
+                hosts.add(host)
+        return hosts
+
+    def _job_key(self, job_id):
+        """qstat -a truncates job ids to 20 characters while accounting
+        records carry seq.server.fqdn. The sequence number (with any array
+        index) is unique within the one server Phorque watches and survives
+        truncation, so jobs are keyed by it."""
+        return job_id.split(".", 1)[0]
+
+    def _qstat(self, job_ids=[]):
+        qstat = Command([" ".join([self._qstat_cmd] + list(job_ids))])
         qstat_rc = qstat.execute()
         if qstat_rc != 0:
             LOG.error("qstat returned %d" % qstat_rc)
-            return
+            # qstat also fails when some of the requested jobs are gone,
+            # the others are still listed
+            if not job_ids:
+                return None
         job_line = "(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+"
         job_line += "(\d+)\s+(\d+)\s+(\S+)\s+(\S+)\s+([A-Z])\s+(\S+)"
+        job_line += "(?:\s+(\S+))?"
         job_pattern = re.compile(job_line)
-        queued_cores = 0
-        queued_jobs = 0
-        total_jobs = 0
+        jobs = {}
+        now = time.time()
         for line in qstat.stdout.split('\n'):
             match = job_pattern.match(line)
             if match:
-                if match.group(10) == 'Q':
-                    queued_cores += int(match.group(7))
-                    queued_jobs += 1
-                total_jobs += 1
+                job_id = self._job_key(match.group(1))
+                previous = self._jobs.get(job_id)
+                job = Job(job_id, match.group(10), int(match.group(7)))
+                if job.state == 'Q':
+                    if previous is not None and previous.queued_since:
+                        job.queued_since = previous.queued_since
+                    else:
+                        job.queued_since = now
+                elif job.state == 'R' and match.group(12):
+                    job.exec_hosts = self._parse_exec_hosts(match.group(12))
+                    walltime = self._parse_secs(match.group(9))
+                    elapsed = self._parse_secs(match.group(11))
+                    if walltime is not None and elapsed is not None:
+                        job.end_time = now + max(walltime - elapsed, 0)
+                jobs[job_id] = job
+        if qstat_rc != 0 and not jobs:
+            return None
+        return jobs
+
+    def _scan_jobs(self):
+        if self._accounting is not None:
+            # events up to now are covered by the scan
+            self._accounting.read_events()
+        jobs = self._qstat()
+        if jobs is None:
+            return
+        self._jobs = jobs
+        self._last_full_scan = time.time()
+
+    def _apply_event(self, event, new_job_ids):
+        job_id = self._job_key(event.job_id)
+        job = self._jobs.get(job_id)
+        if event.type == 'Q':
+            if job is None:
+                self._jobs[job_id] = Job(job_id, 'Q', None, event.time)
+                new_job_ids.append(event.job_id)
+        elif event.type == 'S':
+            exec_host = event.attrs.get("exec_host", "")
+            if job is None:
+                job = Job(job_id, 'R', None)
+                self._jobs[job_id] = job
+            job.state = 'R'
+            job.exec_hosts = self._parse_exec_hosts(exec_host)
+            if exec_host:
+                job.cores = len(exec_host.split("+"))
+            walltime = self._parse_secs(
+                event.attrs.get("Resource_List.walltime", ""))
+            start = float(event.attrs.get("start", event.time))
+            if walltime is not None:
+                job.end_time = start + walltime
+        elif event.type == 'R':
+            if job is not None:
+                job.state = 'Q'
+                job.exec_hosts = ()
+                job.end_time = None
+                job.queued_since = event.time
+        elif event.type in ('E', 'D', 'A'):
+            self._jobs.pop(job_id, None)
+
+    def _lookup_job_cores(self, job_ids):
+        """Q records do not say how many cores a job needs, look them up by
+        their full ids. Returns False if any lookup failed."""
+        found = True
+        for i in range(0, len(job_ids), QSTAT_BATCH_SIZE):
+            batch = job_ids[i:i + QSTAT_BATCH_SIZE]
+            try:
+                jobs = self._qstat(batch)
+            except Exception as e:
+                LOG.error("Error looking up new jobs: %s" % str(e))
+                jobs = None
+            if jobs is None:
+                found = False
+                jobs = {}
+            for job_id in batch:
+                key = self._job_key(job_id)
+                if key in jobs:
+                    self._jobs[key].cores = jobs[key].cores
+                else:
+                    LOG.warn("Unable to find cores for job %s" % job_id)
+                    self._jobs[key].cores = 1
+        return found
+
+    def _read_job_events(self):
+        new_job_ids = []
+        for event in self._accounting.read_events():
+            self._apply_event(event, new_job_ids)
+        new_job_ids = [job_id for job_id in new_job_ids
+                       if self._job_key(job_id) in self._jobs]
+        if new_job_ids and not self._lookup_job_cores(new_job_ids):
+            LOG.warn("Scanning all jobs in the next iteration")
+            self._last_full_scan = None
+        LOG.debug("Applied job events, %d new jobs" % len(new_job_ids))
+
+    def _update_job_info(self):
+        if (self._accounting is None or self._last_full_scan is None or
+                time.time() - self._last_full_scan >= self.full_scan_secs):
+            LOG.debug("Scanning all jobs")
+            self._scan_jobs()
+        else:
+            self._read_job_events()
+        queued_cores = 0
+        queued_jobs = 0
+        node_jobs = {}
+        now = time.time()
+        for job in self._jobs.values():
+            if job.state == 'Q':
+                queued_cores += job.cores or 0
+                queued_jobs += 1
+            elif job.state == 'R':
+                if job.end_time is None:
+                    secs_left = None
+                else:
+                    secs_left = max(job.end_time - now, 0)
+                for host in job.exec_hosts:
+                    node_jobs.setdefault(host, []).append(secs_left)
+        self._node_jobs = node_jobs
         self.num_queued_jobs = queued_jobs
         self.num_queued_cores = queued_cores
-        self.num_total_jobs = total_jobs
+        self.num_total_jobs = len(self._jobs)
         LOG.debug("Jobs updated: %s total jobs and %s queued cores." % (
             self.num_total_jobs, self.num_queued_cores))
 
     def _update_node_info(self):
-        self.nodes = []
         self.num_total_nodes = 0
         self.num_total_cores = 0
         self.num_free_cores = 0
@@ -83,24 +268,40 @@ class TorqueCluster(BaseCluster):
             return
         node_line = "\n(\S+)\n\s+state\s=\s(\S+)\n\s+np\s=\s(\d+)\n"
         node_pattern = re.compile(node_line)
-        matches = re.findall(node_pattern, pbsnodes.stdout)
-        for match in matches:
-            n = Node(match[0], int(match[2]), match[1])
+        # Node objects are kept between polls and updated in place
+        nodes = []
+        nodes_by_name = {}
+        for match in node_pattern.finditer(pbsnodes.stdout):
+            (public_dns_name, state, np) = match.groups()
+            n = self._nodes_by_name.get(public_dns_name)
+            if n is None:
+                n = Node(public_dns_name, int(np), state)
+            else:
+                n.update(int(np), state)
+            jobs = self._node_jobs.get(n.public_dns_name, [])
+            n.num_running_jobs = len(jobs)
+            if None in jobs:
+                n.secs_until_free = None
+            elif jobs:
+                n.secs_until_free = max(jobs)
             self.num_total_nodes += 1
-            self.num_total_cores += int(match[2])
-            if match[1] == "free":
-                self.num_free_cores += int(match[2])
-            if "down" in match[1]:
-                self.num_down_cores += int(match[2])
-            if "down" not in match[1]:
-                if n.public_dns_name not in self._has_booted:
-                    self._has_booted.append(n.public_dns_name)
-            self.nodes.append(n)
+            self.num_total_cores += n.np
+            if state == "free":
+                self.num_free_cores += n.np
+            if "down" in state:
+                self.num_down_cores += n.np
+            else:
+                self._has_booted.add(public_dns_name)
+            nodes.append(n)
+            nodes_by_name[public_dns_name] = n
+        self.nodes = nodes
+        self._nodes_by_name = nodes_by_name
+        self._drained &= set(nodes_by_name)
         LOG.debug("Nodes updated: %s total nodes and %s total cores." % (
             self.num_total_nodes, self.num_total_cores))
 
     def _update_public_dns_names(self):
-        self._public_dns_names = [x.public_dns_name for x in self.nodes]
+        self._public_dns_names = set(self._nodes_by_name)
 
     def _add_new_node(self, public_dns_name, np):
         qmgr_cmd = str(self._qmgr_cmd) + " -c \"create node %s np=%d\""
@@ -109,8 +310,10 @@ class TorqueCluster(BaseCluster):
         add_node_rc = add_node.execute()
         if add_node_rc != 0:
             LOG.error("qmgr returned %d" % add_node_rc)
-            return
+            return False
+        self._public_dns_names.add(public_dns_name)
         LOG.debug("Successfully added node: %s" % public_dns_name)
+        return True
 
     def _remove_node(self, public_dns_name):
         qmgr_cmd = str(self._qmgr_cmd) + " -c \"delete node %s\""
@@ -120,22 +323,26 @@ class TorqueCluster(BaseCluster):
         if remove_node_rc != 0:
             LOG.error("qmgr returned %d" % remove_node_rc)
             return
-        if public_dns_name in self._has_booted:
-            self._has_booted.remove(public_dns_name)
+        self._public_dns_names.discard(public_dns_name)
+        self._has_booted.discard(public_dns_name)
+        self._drained.discard(public_dns_name)
         LOG.debug("Successfully removed node: %s" % public_dns_name)
 
     def remove_node(self, public_dns_name):
-        if public_dns_name in self._public_dns_names:
-            LOG.debug("%s is in the cluster, removing" % public_dns_name)
-            self._remove_node(public_dns_name)
-        else:
-            LOG.debug("%s is not in the cluster, cannot remove" % (
-                public_dns_name))
+        with self._lock:
+            if public_dns_name in self._public_dns_names:
+                LOG.debug("%s is in the cluster, removing" % public_dns_name)
+                self._remove_node(public_dns_name)
+            else:
+                LOG.debug("%s is not in the cluster, cannot remove" % (
+                    public_dns_name))
 
     def add_node(self, public_dns_name, np=1):
-        if not (public_dns_name in self._public_dns_names):
-            LOG.debug("Adding node to cluster: %s" % public_dns_name)
-            self._add_new_node(public_dns_name, np)
+        with self._lock:
+            if not (public_dns_name in self._public_dns_names):
+                LOG.debug("Adding node to cluster: %s" % public_dns_name)
+                return self._add_new_node(public_dns_name, np)
+            return True
 
     def offline_node(self, public_dns_name):
         pbsnodes_cmd = str(self._pbsnodes_cmd) + " -o %s"
@@ -147,15 +354,44 @@ class TorqueCluster(BaseCluster):
             return
         else:
             LOG.debug("Successfully marked node offline: %s" % public_dns_name)
-            for node in self.nodes:
-                if node.public_dns_name == public_dns_name:
-                    node.terminate_me = True
+            node = self._nodes_by_name.get(public_dns_name)
+            # nodes still running jobs drain and are terminated once they
+            # show up idle
+            if node is not None and not node.num_running_jobs:
+                node.terminate_me = True
+            else:
+                self._drained.add(public_dns_name)
+
+    def clear_offline_node(self, public_dns_name):
+        pbsnodes_cmd = str(self._pbsnodes_cmd) + " -c %s"
+        pbsnodes_cmd = pbsnodes_cmd % public_dns_name
+        clear_node = Command([pbsnodes_cmd])
+        clear_node_rc = clear_node.execute()
+        if clear_node_rc != 0:
+            LOG.error("pbsnodes returned %d" % clear_node_rc)
+            return
+        LOG.debug("Successfully cleared offline node: %s" % public_dns_name)
+        self._drained.discard(public_dns_name)
+
+    def register_ready_node(self, public_dns_name, np=1):
+        """Adds a node that reported itself ready and counts it as booted.
+
+        Called from the readiness listener, refreshes still add nodes that
+        never call back. Returns False if the node could not be added.
+        """
+        with self._lock:
+            if not self.add_node(public_dns_name, np):
+                return False
+            self._has_booted.add(public_dns_name)
+            return True
 
     def update(self):
         LOG.debug("Updating cluster nodes and job information.")
-        self._update_job_info()
-        self._update_node_info()
-        self._update_public_dns_names()
+        with self._lock:
+            # job information first so nodes can be matched to running jobs
+            self._update_job_info()
+            self._update_node_info()
+            self._update_public_dns_names()
         LOG.debug("Nodes successfully booted: %s" % self._has_booted)
 
     def get_num_queued_jobs(self):
@@ -164,6 +400,19 @@ class TorqueCluster(BaseCluster):
     def get_num_queued_job_cores(self):
         return self.num_queued_cores
 
+    def get_queued_job_wait_secs(self):
+        """Seconds each queued job has waited since it was first seen."""
+        now = time.time()
+        return [now - job.queued_since for job in self._jobs.values()
+                if job.state == 'Q' and job.queued_since is not None]
+
+    def get_queued_job_wait_percentile(self, percentile):
+        waits = sorted(self.get_queued_job_wait_secs())
+        if not waits:
+            return 0
+        rank = int(math.ceil(percentile / 100.0 * len(waits)))
+        return waits[max(rank, 1) - 1]
+
     def get_num_total_jobs(self):
         return self.num_total_jobs
 
@@ -192,3 +441,27 @@ class TorqueCluster(BaseCluster):
                     names.append(node.public_dns_name)
         LOG.debug("Public DNS names of idle and down nodes: %s" % names)
         return names
+
+    def get_public_dns_names_of_drained_nodes(self):
+        """Nodes Phorque marked offline while they were running jobs."""
+        return sorted(self._drained)
+
+    def get_public_dns_names_of_draining_nodes(self, secs_to_charge,
+                                               margin_secs=0):
+        """Booted nodes running jobs that are estimated to finish at least
+        margin_secs before the node's next charge boundary."""
+        names = []
+        for node in self.nodes:
+            if not node.num_running_jobs or node.secs_until_free is None:
+                continue
+            if node.public_dns_name not in self._has_booted:
+                continue
+            if ("down" in node.state) or ("offline" in node.state):
+                continue
+            secs = secs_to_charge.get(node.public_dns_name)
+            if secs is None:
+                continue
+            if node.secs_until_free + margin_secs < secs:
+                names.append(node.public_dns_name)
+        LOG.debug("Public DNS names of draining nodes: %s" % names)
+        return names
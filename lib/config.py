@@ -2,6 +2,7 @@ import os
 
 
 VALID_RUN_STATES = ["running", "pending"]
+WARM_POOL_STATES = ["stopping", "stopped"]
 
 
 class CloudConfig(object):
@@ -26,6 +27,19 @@ class CloudConfig(object):
             self.user_data_file = self._config.get(name, "user_data_file")
         else:
             self.user_data_file = None
+        if self._config.has_option(name, "warm_pool_size"):
+            self.warm_pool_size = self._config.getint(name, "warm_pool_size")
+        else:
+            self.warm_pool_size = 0
+        if self._config.has_option(name, "warm_pool_price"):
+            self.warm_pool_price = self._config.getfloat(name,
+                                                         "warm_pool_price")
+        else:
+            self.warm_pool_price = 0.0
+        if self._config.has_option(name, "is_secure"):
+            self.is_secure = self._config.getboolean(name, "is_secure")
+        else:
+            self.is_secure = True
         access_id = self._config.get(name, "access_id")
         try:
             self.access_id = os.environ[access_id.lstrip('$')]
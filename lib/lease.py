@@ -0,0 +1,148 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+
+from threading import Event
+from threading import Thread
+
+
+LOG = logging.getLogger(__name__)
+
+
+class FencedError(Exception):
+    pass
+
+
+class Lease(object):
+    """A leadership lease kept in a file shared by Phorque processes.
+
+    The file holds the owner, when the lease expires, a fencing token that
+    increases every time the lease changes hands and the state the owner
+    publishes for its standby. Every read-modify-write happens under an
+    exclusive flock, so the file must be on a filesystem with working
+    locks.
+    """
+    def __init__(self, path, ttl_secs=15, owner=None):
+        self.path = path
+        self.ttl_secs = ttl_secs
+        if owner is None:
+            owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.owner = owner
+        self.token = None
+
+    def _update(self, func):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            contents = os.read(fd, os.fstat(fd).st_size or 1)
+            try:
+                record = json.loads(contents)
+            except ValueError:
+                record = {"owner": None, "expires": 0, "token": 0,
+                          "state": {}}
+            new_record = func(record)
+            if new_record is not None:
+                data = json.dumps(new_record).encode("utf-8")
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+                os.fsync(fd)
+            return record
+        finally:
+            os.close(fd)
+
+    def _is_mine(self, record, now):
+        return (record["owner"] == self.owner and
+                record["token"] == self.token and record["expires"] > now)
+
+    def acquire(self):
+        """Takes over an expired lease or renews our own, returns whether
+        we hold it."""
+        now = time.time()
+        result = {}
+
+        def take(record):
+            if self._is_mine(record, now):
+                token = record["token"]
+            elif record["owner"] is None or record["expires"] <= now:
+                token = record["token"] + 1
+            else:
+                return None
+            result["token"] = token
+            record.update(owner=self.owner, expires=now + self.ttl_secs,
+                          token=token)
+            return record
+
+        self._update(take)
+        self.token = result.get("token")
+        return self.token is not None
+
+    def release(self):
+        def give_up(record):
+            if self._is_mine(record, time.time()):
+                record.update(owner=None, expires=0)
+                return record
+        self._update(give_up)
+        self.token = None
+
+    def is_held(self):
+        """Fencing check, true only if our token is still the current one."""
+        return self._is_mine(self._update(lambda record: None), time.time())
+
+    def publish(self, state):
+        def store(record):
+            if self._is_mine(record, time.time()):
+                record["state"] = state
+                return record
+        self._update(store)
+
+    def read_state(self):
+        return self._update(lambda record: None).get("state", {})
+
+
+class LeaseKeeper(Thread):
+    """Renews, or tries to take over, the lease every third of its ttl and
+    sets wake when this process becomes the active one.
+
+    It only does so while the main loop keeps calling beat(), so a loop
+    that is wedged lets the lease expire instead of holding it forever.
+    """
+    def __init__(self, lease, wake):
+        Thread.__init__(self)
+        self.daemon = True
+        self.lease = lease
+        self.wake = wake
+        self.stopped = Event()
+        self._renew_until = 0
+
+    def beat(self, secs):
+        """Keeps renewing the lease for up to secs from now."""
+        self._renew_until = time.time() + secs
+
+    def _renew(self):
+        if time.time() > self._renew_until:
+            LOG.error("No heartbeat from the main loop, not renewing lease "
+                      "%s" % self.lease.path)
+            return self.lease.is_held()
+        return self.lease.acquire()
+
+    def run(self):
+        held = self.lease.token is not None
+        while not self.stopped.is_set():
+            try:
+                now_held = self._renew()
+            except Exception as e:
+                LOG.error("Error renewing lease: %s" % str(e))
+                now_held = False
+            if now_held and not held:
+                LOG.info("Acquired lease %s (token %s), becoming active" % (
+                    self.lease.path, self.lease.token))
+                self.wake.set()
+            elif held and not now_held:
+                LOG.critical("Lost lease %s, becoming standby" % (
+                    self.lease.path))
+            held = now_held
+            self.stopped.wait(self.lease.ttl_secs / 3.0)
@@ -10,14 +10,54 @@ class BasePolicy(object):
     def __init__(self):
         LOG.debug("Loaded %s policy" % self.__class__.__name__)
 
+    def configure(self, config):
+        """Reads [Policy] options that must be present before the policy is
+        used, raising an error if they are not."""
+        pass
+
     def execute(self, cluster, clouds):
         LOG.debug("Executing %s policy" % self.__class__.__name__)
 
-    def _launch_instances(self, clouds, num_cores_to_launch=0):
+    def _get_num_cores_to_launch(self, cluster, clouds):
+        num_valid_cloud_cores = clouds.get_total_num_valid_cores()
+        num_queued_job_cores = cluster.get_num_queued_job_cores()
+        num_free_cluster_cores = cluster.get_num_free_cluster_cores()
+        num_down_cluster_cores = cluster.get_num_down_cluster_cores()
+        num_total_cluster_cores = cluster.get_num_total_cluster_cores()
+        num_pending_cores = num_valid_cloud_cores - num_total_cluster_cores
+        if num_pending_cores < 0:
+            num_pending_cores = 0
+
+        LOG.debug("%s:num_valid_cloud_cores: %d" % (self.__class__.__name__,
+                                                    num_valid_cloud_cores))
+        LOG.debug("%s:num_queued_job_cores: %d" % (self.__class__.__name__,
+                                                   num_queued_job_cores))
+        LOG.debug("%s:num_free_cluster_cores: %d" % (self.__class__.__name__,
+                                                     num_free_cluster_cores))
+        LOG.debug("%s:num_down_cluster_cores: %d" % (self.__class__.__name__,
+                                                     num_down_cluster_cores))
+        LOG.debug("%s:num_total_cluster_cores: %d" % (self.__class__.__name__,
+                                                      num_total_cluster_cores))
+        LOG.debug("%s:num_pending_cores: %d" % (self.__class__.__name__,
+                                                num_pending_cores))
+
+        num_cores_to_launch = 0
+        if num_queued_job_cores > 0:
+            num_cores_to_launch = (num_queued_job_cores -
+                                   (num_free_cluster_cores +
+                                   num_pending_cores +
+                                   num_down_cluster_cores))
+
+        LOG.debug("%s: num_cores_to_launch: %d" % (self.__class__.__name__,
+                                                   num_cores_to_launch))
+        return num_cores_to_launch
+
+    def _launch_instances(self, clouds, num_cores_to_launch=0,
+                          multiplier=None):
         cloud = clouds.get_cheapest_valid_cloud()
         if cloud:
             num_valid_instances = len(cloud.get_valid_instances())
-            if (cloud._asg.desired_capacity > num_valid_instances):
+            if (cloud.get_desired_capacity() > num_valid_instances):
                 if cloud.failed_count >= 3:
                     LOG.debug("%s has failed" % cloud.config.name)
                     cloud.failed_launch = True
@@ -36,14 +76,15 @@ class BasePolicy(object):
                     LOG.debug("%s failed count: %s" % (cloud.config.name,
                               cloud.failed_count))
             else:
-                multiplier = clouds._global_config.getint("Policy",
-                                                          "multiplier")
+                if multiplier is None:
+                    multiplier = clouds._global_config.getint("Policy",
+                                                              "multiplier")
                 cores_per_instance = cloud.config.instance_cores
                 num_i = int(math.ceil(num_cores_to_launch /
                                       float(cores_per_instance)))
                 LOG.debug("%s: calculated %d instances to launch" % (
                     self.__class__.__name__, num_i))
-                num_i *= multiplier
+                num_i = int(math.ceil(num_i * multiplier))
                 LOG.debug("%s: launching %d instances" % (
                     self.__class__.__name__, num_i))
                 cloud.launch_autoscale_instances(num_i)
@@ -52,17 +93,59 @@ class BasePolicy(object):
 
     def _mark_nodes_offline(self, cluster, clouds):
         instances_to_charge = []
+        secs_to_charge = {}
         for cloud in clouds.get_clouds_low_to_high():
             instances = cloud.get_public_dns_names_close_to_charge()
             instances_to_charge += instances
+            secs_to_charge.update(
+                cloud.get_secs_to_charge_by_public_dns_name())
         unused_nodes = cluster.get_public_dns_names_of_idle_or_down_nodes(
             require_booted=True)
         offline_nodes = set(instances_to_charge) & set(unused_nodes)
+        # Nodes whose jobs end early enough to terminate them on a later
+        # iteration, before they are charged again, stop accepting jobs now
+        # unless there is queued work they could pick up
+        if not cluster.get_num_queued_job_cores():
+            sleep_secs = clouds._global_config.getint("Phorque",
+                                                      "loop_sleep_secs")
+            draining_nodes = cluster.get_public_dns_names_of_draining_nodes(
+                secs_to_charge, margin_secs=sleep_secs)
+            offline_nodes |= set(instances_to_charge) & set(draining_nodes)
         LOG.debug("Marking nodes offline: %s" % offline_nodes)
         for public_dns_name in offline_nodes:
             cluster.offline_node(public_dns_name)
 
+    def _restore_drained_nodes(self, cluster, clouds):
+        """Puts drained nodes back in service when jobs are queued again or
+        when they were not terminated before their charge boundary."""
+        drained = cluster.get_public_dns_names_of_drained_nodes()
+        if not drained:
+            return
+        if cluster.get_num_queued_job_cores() > 0:
+            to_clear = drained
+        else:
+            known = set()
+            close_to_charge = set()
+            for cloud in clouds.get_clouds_low_to_high():
+                known.update(cloud.get_secs_to_charge_by_public_dns_name())
+                close_to_charge.update(
+                    cloud.get_public_dns_names_close_to_charge())
+            # draining only starts close to the charge boundary, so a node
+            # outside that window has already been charged again
+            to_clear = [name for name in drained
+                        if name in known and name not in close_to_charge]
+        LOG.debug("%s: clearing offline drained nodes: %s" % (
+            self.__class__.__name__, to_clear))
+        for public_dns_name in to_clear:
+            cluster.clear_offline_node(public_dns_name)
+
+    def _get_price_per_hour(self, clouds):
+        if clouds._global_config.has_option("Policy", "price_per_hour"):
+            return clouds._global_config.getfloat("Policy", "price_per_hour")
+        return None
+
     def _terminate_nodes(self, cluster, clouds):
+        price_per_hour = self._get_price_per_hour(clouds)
         to_terminate = []
         for node in cluster.nodes:
             if node.terminate_me:
@@ -77,7 +160,14 @@ class BasePolicy(object):
                 cloud.failed_launch = False
                 cloud.failed_count = 0
                 cloud.failed_last_valid_count = 0
-            cloud.delete_instances(ids)
+            limit = cloud.get_warm_pool_limit(price_per_hour)
+            num_to_stop = max(limit - len(cloud.warm_pool), 0)
+            excess = sorted(cloud.warm_pool)[limit:]
+            if excess:
+                LOG.debug("%s: shrinking warm pool of %s by %d" % (
+                    self.__class__.__name__, cloud.config.name, len(excess)))
+            cloud.stop_instances(ids[:num_to_stop])
+            cloud.delete_instances(ids[num_to_stop:] + excess)
         LOG.debug("%s: removing nodes from cluster" % self.__class__.__name__)
         for public_dns_name in to_terminate:
             cluster.remove_node(public_dns_name)
@@ -102,39 +192,133 @@ class OnDemandPlusPlus(BasePolicy):
 
     def execute(self, cluster, clouds):
         super(OnDemandPlusPlus, self).execute(cluster, clouds)
-        num_valid_cloud_cores = clouds.get_total_num_valid_cores()
-        num_queued_job_cores = cluster.get_num_queued_job_cores()
-        num_free_cluster_cores = cluster.get_num_free_cluster_cores()
-        num_down_cluster_cores = cluster.get_num_down_cluster_cores()
-        num_total_cluster_cores = cluster.get_num_total_cluster_cores()
-        num_pending_cores = num_valid_cloud_cores - num_total_cluster_cores
-        if num_pending_cores < 0:
-            num_pending_cores = 0
-
-        LOG.debug("%s:num_valid_cloud_cores: %d" % (self.__class__.__name__,
-                                                    num_valid_cloud_cores))
-        LOG.debug("%s:num_queued_job_cores: %d" % (self.__class__.__name__,
-                                                   num_queued_job_cores))
-        LOG.debug("%s:num_free_cluster_cores: %d" % (self.__class__.__name__,
-                                                     num_free_cluster_cores))
-        LOG.debug("%s:num_down_cluster_cores: %d" % (self.__class__.__name__,
-                                                     num_down_cluster_cores))
-        LOG.debug("%s:num_total_cluster_cores: %d" % (self.__class__.__name__,
-                                                      num_total_cluster_cores))
-        LOG.debug("%s:num_pending_cores: %d" % (self.__class__.__name__,
-                                                num_pending_cores))
-
-        num_cores_to_launch = 0
-        if num_queued_job_cores > 0:
-            num_cores_to_launch = (num_queued_job_cores -
-                                   (num_free_cluster_cores +
-                                   num_pending_cores +
-                                   num_down_cluster_cores))
-
-        LOG.debug("%s: num_cores_to_launch: %d" % (self.__class__.__name__,
-                                                   num_cores_to_launch))
+        self._restore_drained_nodes(cluster, clouds)
+        num_cores_to_launch = self._get_num_cores_to_launch(cluster, clouds)
 
         if num_cores_to_launch > 0:
             self._launch_instances(clouds, num_cores_to_launch)
         else:
             self._terminate_idle_instances_before_charge(cluster, clouds)
+
+
+class FeedbackController(object):
+    """PID-style controller turning a measured queue wait into a gain.
+
+    The error is normalized by the target so the gains do not depend on the
+    scale of the target. The integral never goes below zero and is capped
+    (anti-windup), and the output is smoothed so the gain cannot swing from
+    one extreme to the other in a single iteration. It has no side effects,
+    so it can be tuned by feeding it recorded wait times.
+    """
+    def __init__(self, target, kp=1.0, ki=0.1, kd=0.0, min_output=0.25,
+                 max_output=4.0, smoothing=0.5):
+        self.target = float(target)
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.min_output = min_output
+        self.max_output = max_output
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.error = None
+        self.output = 1.0
+
+    def _clamp(self, value):
+        return max(self.min_output, min(self.max_output, value))
+
+    def update(self, measured):
+        error = (measured - self.target) / self.target
+        if self.error is None:
+            derivative = 0.0
+        else:
+            derivative = error - self.error
+        self.error = error
+        # The integral only remembers waits above the target, so a run of
+        # short waits cannot hold the gain down once the target is missed.
+        integral = max(self.integral + error, 0.0)
+        if self.ki > 0:
+            # the integral term alone never pushes the output past its limit
+            integral = min(integral, (self.max_output - 1.0) / self.ki)
+        self.integral = integral
+        raw = 1.0 + (self.kp * error + self.ki * self.integral +
+                     self.kd * derivative)
+        previous = self.output
+        if error > 0:
+            # while the target is missed never start from a gain below 1.0,
+            # however low it was while waits were short
+            previous = max(previous, 1.0)
+        self.output = self._clamp(self.smoothing * previous +
+                                  (1.0 - self.smoothing) * self._clamp(raw))
+        return self.output
+
+
+class QueueTimeSLO(BasePolicy):
+    """Scales to keep the p95 queue wait near [Policy] target_wait_secs.
+
+    The controller output replaces the static multiplier when launching and
+    stretches how long the policy waits after a launch before it terminates
+    idle instances again.
+    """
+    def __init__(self):
+        super(QueueTimeSLO, self).__init__()
+        self.controller = None
+        self.deadband = 0.2
+        self.hold_iterations = 3
+        self._iterations_since_launch = None
+
+    def _get_option(self, config, option, default):
+        if config.has_option("Policy", option):
+            return config.getfloat("Policy", option)
+        return default
+
+    def configure(self, config):
+        get = lambda option, default: self._get_option(config, option,
+                                                       default)
+        self.controller = FeedbackController(
+            config.getfloat("Policy", "target_wait_secs"),
+            kp=get("kp", 1.0),
+            ki=get("ki", 0.1),
+            kd=get("kd", 0.0),
+            min_output=get("min_gain", 0.25),
+            max_output=get("max_gain", 4.0),
+            smoothing=get("smoothing", 0.5))
+        self.deadband = get("deadband", 0.2)
+        self.hold_iterations = int(get("scale_down_hold_iterations", 3))
+
+    def execute(self, cluster, clouds):
+        super(QueueTimeSLO, self).execute(cluster, clouds)
+        self._restore_drained_nodes(cluster, clouds)
+        if self.controller is None:
+            self.configure(clouds._global_config)
+        if not cluster.get_num_queued_jobs():
+            # an empty queue has no backlog worth remembering, this keeps
+            # idle periods from winding up the integral
+            self.controller.reset()
+        wait_secs = cluster.get_queued_job_wait_percentile(95)
+        gain = self.controller.update(wait_secs)
+        error = self.controller.error
+        LOG.debug("%s: p95 wait: %d; error: %.2f; gain: %.2f" % (
+            self.__class__.__name__, wait_secs, error, gain))
+        num_cores_to_launch = self._get_num_cores_to_launch(cluster, clouds)
+        if self._iterations_since_launch is not None:
+            self._iterations_since_launch += 1
+
+        if num_cores_to_launch > 0:
+            # the queue is short of cores, never scale down, but only launch
+            # once the wait gets close to the target
+            if error > -self.deadband:
+                self._launch_instances(clouds, num_cores_to_launch,
+                                       multiplier=gain)
+                self._iterations_since_launch = 0
+        elif error < self.deadband:
+            hold = int(math.ceil(self.hold_iterations * gain))
+            if (self._iterations_since_launch is None or
+                    self._iterations_since_launch >= hold):
+                self._terminate_idle_instances_before_charge(cluster, clouds)
+            else:
+                LOG.debug("%s: holding scale down for %d more iterations" % (
+                    self.__class__.__name__,
+                    hold - self._iterations_since_launch))
@@ -0,0 +1,202 @@
+import copy
+import logging
+
+from cloud.clouds import Cloud
+from cloud.clouds import Clouds
+from cluster.torque import TorqueCluster
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ShadowAutoScalingGroup(object):
+    def __init__(self, desired_capacity):
+        self.desired_capacity = desired_capacity
+
+
+class ShadowCloud(Cloud):
+    """A copy of a Cloud that records capacity changes instead of making them.
+
+    The instance list is shared with the real cloud, everything the policies
+    mutate (failure counters and desired capacity) is copied.
+    """
+    def __init__(self, cloud, actions):
+        self.config = cloud.config
+        self.all_instances = cloud.all_instances
+        self.failed_launch = cloud.failed_launch
+        self.failed_count = cloud.failed_count
+        self.failed_last_valid_count = cloud.failed_last_valid_count
+        self.maxed = cloud.maxed
+        self.draining = cloud.draining
+        self.warm_pool = set(cloud.warm_pool)
+        self._asg = ShadowAutoScalingGroup(cloud._asg.desired_capacity)
+        self._last_launch_attempt = cloud._last_launch_attempt
+        self._actions = actions
+
+    def delete_instances(self, instance_ids=[]):
+        if not instance_ids:
+            return
+        self._actions.append(("delete_instances", self.config.name,
+                              sorted(instance_ids)))
+        # terminating through the autoscale group lowers its capacity
+        self._asg.desired_capacity -= len(instance_ids)
+        self.warm_pool.difference_update(instance_ids)
+
+    def stop_instances(self, instance_ids=[]):
+        if not instance_ids:
+            return
+        self._actions.append(("stop_instances", self.config.name,
+                              sorted(instance_ids)))
+        self.warm_pool.update(instance_ids)
+
+    def start_instances(self, instance_ids=[]):
+        if not instance_ids:
+            return
+        self._actions.append(("start_instances", self.config.name,
+                              sorted(instance_ids)))
+        self.warm_pool.difference_update(instance_ids)
+
+    def set_capacity(self, new_capacity):
+        self._actions.append(("set_capacity", self.config.name,
+                              new_capacity))
+        self._asg.desired_capacity = new_capacity
+
+
+class ShadowClouds(Clouds):
+    def __init__(self, clouds, actions):
+        self.cloud_names = clouds.cloud_names
+        self._global_config = clouds._global_config
+        self._instances_out_of_date = []
+        self._draining_clouds = []
+        self.clouds = {}
+        self._clouds_low_to_high = []
+        for cloud in clouds.get_clouds_low_to_high():
+            shadow = ShadowCloud(cloud, actions)
+            self.clouds[cloud.config.name] = shadow
+            self._clouds_low_to_high.append(shadow)
+
+
+class ShadowCluster(TorqueCluster):
+    """A copy of a TorqueCluster that records node changes."""
+    def __init__(self, cluster, actions):
+        self.__dict__.update(cluster.__dict__)
+        self.nodes = [copy.copy(n) for n in cluster.nodes]
+        self._nodes_by_name = dict((n.public_dns_name, n) for n in self.nodes)
+        self._public_dns_names = set(cluster._public_dns_names)
+        self._has_booted = set(cluster._has_booted)
+        self._drained = set(cluster._drained)
+        self._actions = actions
+
+    def offline_node(self, public_dns_name):
+        self._actions.append(("offline_node", public_dns_name))
+        node = self._nodes_by_name.get(public_dns_name)
+        if node is not None and not node.num_running_jobs:
+            node.terminate_me = True
+        elif node is not None:
+            self._drained.add(public_dns_name)
+
+    def clear_offline_node(self, public_dns_name):
+        self._actions.append(("clear_offline_node", public_dns_name))
+        self._drained.discard(public_dns_name)
+
+    def remove_node(self, public_dns_name):
+        if public_dns_name in self._public_dns_names:
+            self._actions.append(("remove_node", public_dns_name))
+
+    def add_node(self, public_dns_name, np=1):
+        if not (public_dns_name in self._public_dns_names):
+            self._actions.append(("add_node", public_dns_name))
+        return True
+
+
+class ShadowResult(object):
+    def __init__(self, policy_name, actions, clouds, cluster,
+                 loop_sleep_secs):
+        self.policy_name = policy_name
+        self.actions = actions
+        self.capacity = {}
+        self.hourly_cost = 0.0
+        num_cores = 0
+        for cloud in clouds.get_clouds_low_to_high():
+            name = cloud.config.name
+            capacity = max(cloud.get_desired_capacity(), 0)
+            self.capacity[name] = capacity
+            num_cores += capacity * cloud.config.instance_cores
+            self.hourly_cost += ((capacity * cloud.config.price +
+                                  len(cloud.warm_pool) *
+                                  cloud.config.warm_pool_price) * 3600.0 /
+                                 cloud.config.charge_time_secs)
+        # Every queued core that the resulting capacity cannot cover waits
+        # at least one more loop iteration.
+        num_busy_cores = (cluster.get_num_total_cluster_cores() -
+                          cluster.get_num_free_cluster_cores() -
+                          cluster.get_num_down_cluster_cores())
+        num_available_cores = num_cores - num_busy_cores
+        self.unserved_cores = max(cluster.get_num_queued_job_cores() -
+                                  max(num_available_cores, 0), 0)
+        self.wait_core_secs = self.unserved_cores * loop_sleep_secs
+
+    def __repr__(self):
+        return "ShadowResult<%s, capacity=%s, cost/h=%.2f, wait=%d>" % (
+            self.policy_name, self.capacity, self.hourly_cost,
+            self.wait_core_secs)
+
+
+class ShadowRunner(object):
+    """Evaluates candidate policies against the same cluster and cloud
+    snapshot as the active policy without acting on their decisions."""
+    def __init__(self, active_policy, shadow_policies, loop_sleep_secs):
+        self.active_policy = active_policy
+        self.shadow_policies = shadow_policies
+        self.loop_sleep_secs = loop_sleep_secs
+        self.totals = {}
+
+    def _evaluate(self, policy, cluster, clouds):
+        actions = []
+        shadow_cluster = ShadowCluster(cluster, actions)
+        shadow_clouds = ShadowClouds(clouds, actions)
+        policy.execute(shadow_cluster, shadow_clouds)
+        return ShadowResult(policy.__class__.__name__, actions,
+                            shadow_clouds, shadow_cluster,
+                            self.loop_sleep_secs)
+
+    def _record(self, result):
+        totals = self.totals.setdefault(result.policy_name,
+                                        {"iterations": 0,
+                                         "diverged": 0,
+                                         "cost": 0.0,
+                                         "wait_core_secs": 0})
+        totals["iterations"] += 1
+        totals["cost"] += (result.hourly_cost * self.loop_sleep_secs /
+                           3600.0)
+        totals["wait_core_secs"] += result.wait_core_secs
+        return totals
+
+    def execute(self, cluster, clouds):
+        """Must be called before the active policy acts on the snapshot."""
+        active = self._evaluate(self.active_policy, cluster, clouds)
+        self._record(active)
+        results = [active]
+        for policy in self.shadow_policies:
+            try:
+                result = self._evaluate(policy, cluster, clouds)
+            except Exception as e:
+                LOG.error("Error executing shadow policy %s: %s" % (
+                    policy.__class__.__name__, str(e)))
+                continue
+            totals = self._record(result)
+            diverged = result.actions != active.actions
+            if diverged:
+                totals["diverged"] += 1
+                LOG.info("Shadow %s diverged from %s: %s vs %s" % (
+                    result.policy_name, active.policy_name,
+                    result.actions, active.actions))
+            LOG.info("Shadow %s: cost/h %.2f (active %.2f), "
+                     "wait core-secs %d (active %d)" % (
+                         result.policy_name, result.hourly_cost,
+                         active.hourly_cost, result.wait_core_secs,
+                         active.wait_core_secs))
+            results.append(result)
+        for name, totals in self.totals.items():
+            LOG.debug("Shadow totals for %s: %s" % (name, totals))
+        return results
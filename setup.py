@@ -6,7 +6,7 @@ setup(
     name="phorque",
     version="0.1",
     scripts=["bin/phorque.py"],
-    packages=find_packages(),
+    packages=find_packages(exclude=["bench"]),
     author="Paul Marshall",
     author_email="paul.marshall@colorado.edu",
     license=open("LICENSE.txt").read(),
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cluster.accounting import AccountingLog
+
+
+def record(type, job_id, attrs=""):
+    return "10/19/2026 12:00:00;%s;%s;%s\n" % (type, job_id, attrs)
+
+
+class AccountingLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, "server_priv/accounting"))
+        self._write("20261019", record("Q", "1.server"))
+        self.log = AccountingLog(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, data, mode="a"):
+        path = os.path.join(self.directory, "server_priv/accounting", name)
+        with open(path, mode) as f:
+            f.write(data)
+
+    def _read(self):
+        return [(e.type, e.job_id) for e in self.log.read_events()]
+
+    def test_starts_at_end_of_newest_file(self):
+        self.assertEqual(self._read(), [])
+        self._write("20261019", record("S", "1.server"))
+        self.assertEqual(self._read(), [("S", "1.server")])
+        self.assertEqual(self._read(), [])
+
+    def test_parses_attributes(self):
+        self._write("20261019", record("S", "2.server",
+                                       "user=x exec_host=n1/0+n2/0"))
+        event = self.log.read_events()[0]
+        self.assertEqual(event.attrs, {"user": "x",
+                                       "exec_host": "n1/0+n2/0"})
+
+    def test_partial_line_is_read_once_complete(self):
+        line = record("E", "1.server")
+        self._write("20261019", line[:20])
+        self.assertEqual(self._read(), [])
+        self._write("20261019", line[20:])
+        self.assertEqual(self._read(), [("E", "1.server")])
+
+    def test_rotation_finishes_previous_file(self):
+        self._write("20261019", record("S", "1.server"))
+        self._write("20261020", record("Q", "2.server"))
+        self.assertEqual(self._read(), [("S", "1.server"),
+                                        ("Q", "2.server")])
+        self._write("20261020", record("S", "2.server"))
+        self.assertEqual(self._read(), [("S", "2.server")])
+
+    def test_truncated_file_is_read_from_start(self):
+        self._write("20261019", record("S", "1.server"))
+        self._read()
+        self._write("20261019", record("Q", "3.server"), mode="w")
+        self.assertEqual(self._read(), [("Q", "3.server")])
+
+    def test_malformed_lines_are_skipped(self):
+        self._write("20261019", "garbage\nnot a date;Q;4.server;\n")
+        self._write("20261019", record("Q", "5.server"))
+        self.assertEqual(self._read(), [("Q", "5.server")])
+
+
+if __name__ == "__main__":
+    unittest.main()
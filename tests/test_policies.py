@@ -0,0 +1,100 @@
+import unittest
+
+from policy.policies import FeedbackController
+from policy.policies import QueueTimeSLO
+
+
+class FeedbackControllerTestCase(unittest.TestCase):
+    def _feed(self, controller, waits):
+        for wait in waits:
+            gain = controller.update(wait)
+        return gain
+
+    def test_gain_is_one_at_target(self):
+        controller = FeedbackController(600)
+        self.assertAlmostEqual(self._feed(controller, [600] * 10), 1.0)
+
+    def test_gain_stays_within_limits(self):
+        controller = FeedbackController(600, min_output=0.25, max_output=4.0)
+        self.assertAlmostEqual(self._feed(controller, [60000] * 50), 4.0)
+        self.assertAlmostEqual(self._feed(controller, [0] * 50), 0.25)
+
+    def test_short_waits_do_not_wind_up_integral(self):
+        controller = FeedbackController(600)
+        self._feed(controller, [100] * 100)
+        self.assertEqual(controller.integral, 0.0)
+
+    def test_missed_target_after_short_waits_raises_gain(self):
+        # recorded waits: a long stretch well under target, then a backlog
+        for wait in [700, 900]:
+            controller = FeedbackController(600)
+            self._feed(controller, [100] * 100)
+            gains = [controller.update(wait) for i in range(3)]
+            self.assertTrue(min(gains) > 1.0)
+            self.assertEqual(gains, sorted(gains))
+
+    def test_smoothing_damps_steps(self):
+        controller = FeedbackController(600, smoothing=0.5)
+        first = controller.update(1200)
+        self.assertTrue(1.0 < first < 2.0)
+
+    def test_reset(self):
+        controller = FeedbackController(600)
+        self._feed(controller, [1200] * 5)
+        controller.reset()
+        self.assertEqual(controller.integral, 0.0)
+        self.assertEqual(controller.output, 1.0)
+        self.assertEqual(controller.error, None)
+
+
+class StubCluster(object):
+    def __init__(self, wait_secs):
+        self.wait_secs = wait_secs
+
+    def get_num_queued_jobs(self):
+        return 1
+
+    def get_queued_job_wait_percentile(self, percentile):
+        return self.wait_secs
+
+
+class StubQueueTimeSLO(QueueTimeSLO):
+    def __init__(self, num_cores_to_launch):
+        super(StubQueueTimeSLO, self).__init__()
+        self.controller = FeedbackController(600)
+        self.num_cores_to_launch = num_cores_to_launch
+        self.actions = []
+
+    def _restore_drained_nodes(self, cluster, clouds):
+        pass
+
+    def _get_num_cores_to_launch(self, cluster, clouds):
+        return self.num_cores_to_launch
+
+    def _launch_instances(self, clouds, num_cores_to_launch=0,
+                          multiplier=None):
+        self.actions.append("launch")
+
+    def _terminate_idle_instances_before_charge(self, cluster, clouds):
+        self.actions.append("terminate")
+
+
+class QueueTimeSLOTestCase(unittest.TestCase):
+    def _execute(self, num_cores_to_launch, wait_secs):
+        policy = StubQueueTimeSLO(num_cores_to_launch)
+        policy.execute(StubCluster(wait_secs), None)
+        return policy.actions
+
+    def test_launches_when_wait_near_target(self):
+        self.assertEqual(self._execute(8, 600), ["launch"])
+
+    def test_never_scales_down_while_short_of_cores(self):
+        self.assertEqual(self._execute(8, 10), [])
+
+    def test_scales_down_without_cores_to_launch(self):
+        self.assertEqual(self._execute(0, 10), ["terminate"])
+        self.assertEqual(self._execute(0, 6000), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
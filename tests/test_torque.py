@@ -0,0 +1,123 @@
+import shutil
+import tempfile
+import unittest
+
+from cluster import torque
+from cluster.accounting import AccountingEvent
+from cluster.torque import Job
+from cluster.torque import TorqueCluster
+
+
+class StubTorqueCluster(TorqueCluster):
+    """Answers qstat lookups from a dict instead of running qstat."""
+    def __init__(self, directory, cores_by_key, fail=False):
+        TorqueCluster.__init__(self, directory)
+        self.cores_by_key = cores_by_key
+        self.fail = fail
+        self.lookups = []
+
+    def _qstat(self, job_ids=[]):
+        self.lookups.append(list(job_ids))
+        if self.fail:
+            raise OSError(7, "Argument list too long")
+        jobs = {}
+        for job_id in job_ids:
+            key = self._job_key(job_id)
+            if key in self.cores_by_key:
+                jobs[key] = Job(key, 'Q', self.cores_by_key[key])
+        return jobs
+
+
+class StubAccountingLog(object):
+    def __init__(self, events):
+        self.events = events
+
+    def read_events(self):
+        (events, self.events) = (self.events, [])
+        return events
+
+
+class TorqueClusterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cluster = StubTorqueCluster(self.directory, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _apply(self, type, job_id, time=100.0, **attrs):
+        new_job_ids = []
+        self.cluster._apply_event(AccountingEvent(time, type, job_id, attrs),
+                                  new_job_ids)
+        return new_job_ids
+
+    def test_job_key_survives_truncation(self):
+        self.assertEqual(self.cluster._job_key("1234.torque-head.exampl"),
+                         self.cluster._job_key("1234.torque-head.example.org"))
+        self.assertEqual(self.cluster._job_key("1234[5].server"), "1234[5]")
+
+    def test_queued_job_is_new(self):
+        self.assertEqual(self._apply('Q', "1.server.example.org"),
+                         ["1.server.example.org"])
+        job = self.cluster._jobs["1"]
+        self.assertEqual((job.state, job.cores, job.queued_since),
+                         ('Q', None, 100.0))
+        self.assertEqual(self._apply('Q', "1.server.example.org"), [])
+
+    def test_started_job_runs_on_exec_hosts(self):
+        self._apply('Q', "2.server")
+        self._apply('S', "2.server", time=200.0,
+                    exec_host="n1/0+n1/1+n2/0",
+                    **{"Resource_List.walltime": "00:10:00"})
+        job = self.cluster._jobs["2"]
+        self.assertEqual(job.state, 'R')
+        self.assertEqual(job.cores, 3)
+        self.assertEqual(job.exec_hosts, set(["n1", "n2"]))
+        self.assertEqual(job.end_time, 800.0)
+
+    def test_requeued_job_waits_again(self):
+        self._apply('S', "3.server", exec_host="n1/0")
+        self._apply('R', "3.server", time=300.0)
+        job = self.cluster._jobs["3"]
+        self.assertEqual((job.state, job.exec_hosts, job.queued_since),
+                         ('Q', (), 300.0))
+
+    def test_finished_jobs_are_dropped(self):
+        for (i, type) in enumerate(['E', 'D', 'A']):
+            job_id = "%d.server" % (i + 4)
+            self._apply('Q', job_id)
+            self._apply(type, job_id)
+            self.assertFalse(self.cluster._job_key(job_id) in
+                             self.cluster._jobs)
+
+    def test_new_jobs_are_looked_up_in_batches(self):
+        job_ids = ["%d.server.example.org" % i
+                   for i in range(torque.QSTAT_BATCH_SIZE * 2 + 1)]
+        self.cluster.cores_by_key = dict((str(i), 4)
+                                         for i in range(len(job_ids) - 1))
+        for job_id in job_ids:
+            self._apply('Q', job_id)
+        self.assertTrue(self.cluster._lookup_job_cores(job_ids))
+        self.assertEqual([len(batch) for batch in self.cluster.lookups],
+                         [torque.QSTAT_BATCH_SIZE, torque.QSTAT_BATCH_SIZE, 1])
+        self.assertEqual(self.cluster._jobs["0"].cores, 4)
+        # not listed, most likely finished already
+        self.assertEqual(self.cluster._jobs[str(len(job_ids) - 1)].cores, 1)
+
+    def test_failed_lookup_never_leaves_cores_unknown(self):
+        self.cluster.fail = True
+        self._apply('Q', "6.server")
+        self.assertFalse(self.cluster._lookup_job_cores(["6.server"]))
+        self.assertEqual(self.cluster._jobs["6"].cores, 1)
+
+    def test_failed_lookup_forces_full_scan(self):
+        self.cluster.fail = True
+        self.cluster._last_full_scan = 100.0
+        self.cluster._accounting = StubAccountingLog(
+            [AccountingEvent(100.0, 'Q', "7.server", {})])
+        self.cluster._read_job_events()
+        self.assertEqual(self.cluster._last_full_scan, None)
+
+
+if __name__ == "__main__":
+    unittest.main()